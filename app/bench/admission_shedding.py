@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Check that one chat's backlog doesn't get other chats' group watch mode updates shed:
+a chat's queued jobs wait behind its own running job, not for a worker,
+so they shouldn't count towards the admission queue's latency.
+"""
+import sys
+from argparse import ArgumentParser
+from threading import Event
+from time import sleep
+
+from plumbum import local
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+from colorcodebot import AdmissionQueue  # noqa: E402
+
+
+def backlogged(queue: AdmissionQueue, chat_id: int, jobs: int) -> Event:
+    """Queue jobs for one chat behind a job that runs until the returned event is set"""
+    release = Event()
+    queue.submit('private', chat_id, None, release.wait)
+    for _ in range(jobs):
+        queue.submit('private', chat_id, None, lambda: None)
+    return release
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--shed-latency', type=float, default=0.5)
+    parser.add_argument('--backlog', type=int, default=20)
+    args = parser.parse_args()
+
+    queue = AdmissionQueue(workers=args.workers, shed_latency=args.shed_latency)
+    release = backlogged(queue, 1111, args.backlog)
+    sleep(args.shed_latency * 2)
+
+    print(f"{'depth':>12}: {queue.depth()}")
+    print(f"{'latency':>12}: {queue.latency():.2f}s")
+    future = queue.submit('group watch', -2222, None, lambda: 'done')
+    print(f"{'other chat':>12}: {'shed' if future is None else future.result(5)}")
+    release.set()
+    if future is None:
+        sys.exit("a group watch mode update was shed for another chat's backlog")
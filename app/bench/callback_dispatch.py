@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of routing callback data to a handler:
+YAML payloads tested against one predicate per action, then parsed again by the handler,
+against compact payloads decoded once and looked up in a dispatch table.
+"""
+import sys
+from argparse import ArgumentParser
+from timeit import timeit
+
+from plumbum import local
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+from colorcodebot import CALLBACK_ACTIONS, cbdump, cbload, ydump, yload  # noqa: E402
+
+PAYLOADS = (
+    {'action': 'set ext', 'ext': 'py3'},
+    {'action': 'set theme', 'theme': 'base16/gruvbox-dark-pale'},
+    {'action': 'restore', 'kb_name': 'syntax'},
+    {'action': 'begone'},
+)
+
+HANDLERS = {action: lambda data: data for action in CALLBACK_ACTIONS}
+
+PREDICATE_ORDER = (
+    'restore',
+    'set ext',
+    'set default ext',
+    'browse group syntax',
+    'toggle watch mode',
+    'set theme',
+    'begone',
+)
+
+
+def predicate_dispatch(payload: str):
+    for action in PREDICATE_ORDER:
+        if yload(payload)['action'] == action:
+            return HANDLERS[action](yload(payload))
+
+
+def table_dispatch(payload: str):
+    data = cbload(payload)
+    return HANDLERS[data['action']](cbload(payload))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    for name, dispatch, encode in (
+        ('predicates', predicate_dispatch, ydump),
+        ('table', table_dispatch, cbdump),
+    ):
+        payloads = [encode(data) for data in PAYLOADS]
+        seconds = timeit(
+            lambda: [dispatch(payload) for payload in payloads], number=args.number
+        )
+        print(
+            f"{name:>10}: {seconds / (args.number * len(payloads)) * 1e6:.1f}us"
+            " per callback"
+        )
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Serve a fake Telegram Bot API locally, recording each call,
+with simulated latency and flood control (429) errors,
+so the bot can be load tested without a token or network access.
+"""
+import json
+import random
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import monotonic, sleep, time
+from typing import List, Mapping, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+BOT = {'id': 9999, 'is_bot': True, 'first_name': 'ColorCodeBot', 'username': 'ccb'}
+
+
+class Call(NamedTuple):
+    method: str
+    chat_id: Optional[str]
+    received: float
+    bytes: int
+    flooded: bool
+
+
+class FakeBotAPI:
+    """
+    Answer Bot API requests at http://host:port/bot<token>/<method>
+    with minimal but well-formed results, after a simulated delay.
+    A share of message sending requests (flood_rate) get a 429 instead.
+    Replies embed the message replied to, as Telegram's do,
+    if it was sent by the bot or passed to remember.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        flood_rate: float = 0,
+        retry_after: int = 1,
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls: List[Call] = []
+        self.messages = {}
+        self.message_ids = count(100000)
+        self.file_ids = count(1)
+        self.lock = Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.handle(self)
+
+            def do_POST(self):
+                api.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def remember(self, message: Mapping):
+        with self.lock:
+            self.messages[(message['chat']['id'], message['message_id'])] = message
+
+    def start(self) -> 'FakeBotAPI':
+        Thread(target=self.httpd.serve_forever, name='fake-api', daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        size = int(request.headers.get('Content-Length', 0))
+        request.rfile.read(size)
+        url = urlsplit(request.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+        flooded = method.startswith('send') and random.random() < self.flood_rate
+        with self.lock:
+            self.calls.append(
+                Call(method, params.get('chat_id'), monotonic(), size, flooded)
+            )
+        sleep(max(0, random.gauss(self.latency, self.jitter)))
+        if flooded:
+            status, body = 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }
+        else:
+            status, body = 200, {'ok': True, 'result': self.result(method, params)}
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        request.end_headers()
+        request.wfile.write(payload)
+
+    def message(self, params: Mapping[str, str], **content) -> dict:
+        chat_id = int(params.get('chat_id', 0))
+        with self.lock:
+            message_id = int(params.get('message_id', 0)) or next(self.message_ids)
+            reply_to = self.messages.get(
+                (chat_id, int(params.get('reply_to_message_id', 0)))
+            )
+        message = {
+            'message_id': message_id,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': BOT,
+            **content,
+        }
+        if reply_to:
+            message['reply_to_message'] = reply_to
+        self.remember(message)
+        return message
+
+    def attachment(self, kind: str) -> dict:
+        with self.lock:
+            file_id = f"fake-{kind}-{next(self.file_ids)}"
+        if kind == 'photo':
+            return {
+                'photo': [
+                    {
+                        'file_id': file_id,
+                        'file_unique_id': file_id,
+                        'width': 800,
+                        'height': 600,
+                    }
+                ]
+            }
+        return {'document': {'file_id': file_id, 'file_unique_id': file_id}}
+
+    def result(self, method: str, params: Mapping[str, str]):
+        if method == 'getMe':
+            return BOT
+        if method == 'sendMessage':
+            return self.message(params, text=params.get('text', ''))
+        if method == 'sendPhoto':
+            return self.message(params, **self.attachment('photo'))
+        if method == 'sendDocument':
+            return self.message(params, **self.attachment('document'))
+        if method == 'sendMediaGroup':
+            return [
+                self.message(params, **self.attachment(item['type']))
+                for item in json.loads(params.get('media', '[]'))
+            ]
+        if method.startswith('edit'):
+            return self.message(params)
+        if method == 'getChatAdministrators':
+            return []
+        if method == 'getFile':
+            return {
+                'file_id': params.get('file_id'),
+                'file_unique_id': params.get('file_id'),
+                'file_path': f"files/{params.get('file_id')}",
+            }
+        return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'calls': len(self.calls),
+                'flooded': sum(call.flooded for call in self.calls),
+                'bytes_received': sum(call.bytes for call in self.calls),
+                'methods': dict(Counter(call.method for call in self.calls)),
+            }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(
+        args.latency,
+        args.jitter,
+        args.flood_rate,
+        args.retry_after,
+        host=args.host,
+        port=args.port,
+    )
+    print(f"serving a fake Bot API at {api.url}")
+    try:
+        api.httpd.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(api.stats(), indent=2))
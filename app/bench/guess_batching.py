@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compare guesslang throughput when guessing one snippet per model call,
+against batching concurrent snippets through GuessService.
+"""
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import List, Optional
+
+from plumbum import local
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+from colorcodebot import GuessService, load_guesser  # noqa: E402
+
+CORPUS = (
+    'import os\n\nfor path in os.listdir():\n    print(path.upper())\n',
+    'const xs = [1, 2, 3];\nxs.forEach((x) => console.log(x * 2));\n',
+    '#include <stdio.h>\n\nint main(void) {\n    printf("hi\\n");\n    return 0;\n}\n',
+    'fn main() {\n    let v: Vec<u8> = vec![1, 2];\n    println!("{:?}", v);\n}\n',
+    'SELECT name, count(*) FROM users\nGROUP BY name\nORDER BY 2 DESC;\n',
+    'package main\n\nimport "fmt"\n\nfunc main() {\n\tfmt.Println("hi")\n}\n',
+    'def fib(n)\n  n < 2 ? n : fib(n - 1) + fib(n - 2)\nend\nputs fib(10)\n',
+    'for f in *.txt; do\n  wc -l "$f"\ndone\n',
+    'public class Hi {\n  public static void main(String[] a) {\n    '
+    'System.out.println("hi");\n  }\n}\n',
+    '<?php\n$xs = array_map(fn($x) => $x * 2, [1, 2, 3]);\nprint_r($xs);\n',
+)
+
+
+def load_corpus(folder: Optional[str] = None) -> List[str]:
+    if folder:
+        return [f.read() for f in local.path(folder).walk() if f.is_file()]
+    return list(CORPUS)
+
+
+def per_message(guesser, snippets: List[str]) -> float:
+    start = perf_counter()
+    for snippet in snippets:
+        guesser.probabilities(snippet)
+    return perf_counter() - start
+
+
+def batched(guesser, snippets: List[str], batch_size: int, max_wait: float) -> float:
+    service = GuessService(lambda: guesser, batch_size=batch_size, max_wait=max_wait)
+    service.ready.result()
+    start = perf_counter()
+    for future in [service.submit(snippet) for snippet in snippets]:
+        future.result()
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--corpus', help="folder of snippet files (default: built-in)")
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-wait', type=float, default=0.02)
+    args = parser.parse_args()
+
+    snippets = load_corpus(args.corpus) * args.rounds
+    guesser = load_guesser()
+    guesser.probabilities(snippets[0])  # warm up
+
+    for name, seconds in (
+        ('per-message', per_message(guesser, snippets)),
+        ('batched', batched(guesser, snippets, args.batch_size, args.max_wait)),
+    ):
+        print(
+            f"{name:>12}: {len(snippets)} snippets in {seconds:.2f}s"
+            f" = {len(snippets) / seconds:.1f} snippets/s"
+        )
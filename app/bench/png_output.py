@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Render snippets of increasing length with silicon, then report the bytes each would
+put on the wire and how long it took, with and without PNG optimization,
+and whether it's predicted to go out as a photo or a document.
+"""
+import sys
+from argparse import ArgumentParser
+from time import perf_counter
+
+from plumbum import local
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+from colorcodebot import PngOptimizer, fits_photo, mk_png, png_dimensions  # noqa: E402
+
+LINES = (
+    'def fib(n: int) -> int:',
+    '    """Return the nth Fibonacci number"""',
+    '    return n if n < 2 else fib(n - 1) + fib(n - 2)',
+    '',
+    'for i in range(10):',
+    "    print(f'{i:>3}: {fib(i)}')",
+    '',
+)
+
+
+def snippet(lines: int) -> str:
+    return '\n'.join(LINES[i % len(LINES)] for i in range(lines))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--lines', type=int, nargs='+', default=[10, 50, 200, 1000], metavar='N'
+    )
+    parser.add_argument('--theme', default='Coldark-Dark')
+    parser.add_argument('--quantize-quality', default='65-90')
+    parser.add_argument('--recompress-level', type=int, default=2)
+    args = parser.parse_args()
+
+    optimizer = PngOptimizer(args.quantize_quality, args.recompress_level)
+    print(f"optimizer steps: {', '.join(optimizer.stats()['steps']) or 'none found'}")
+    for lines in args.lines:
+        code = snippet(lines)
+        for name, opt in (('raw', None), ('optimized', optimizer)):
+            start = perf_counter()
+            png = mk_png(code, 'py', args.theme, optimizer=opt)
+            seconds = perf_counter() - start
+            width, height = png_dimensions(png)
+            print(
+                f"{lines:>5} lines {name:>9}: {len(png):>9} bytes"
+                f" {width}x{height} in {seconds * 1000:.0f}ms"
+                f" as {'photo' if fits_photo(png) else 'document'}"
+            )
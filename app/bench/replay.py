@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Replay a synthetic stream of updates through the real handlers,
+against a local fake Bot API, and report end-to-end latency percentiles,
+throughput, and the time spent in each stage (guesslang, silicon, highlight,
+PNG optimization, uploads and other API calls).
+
+The stream is built from recorded updates (private snippets, group code/pre entities,
+callbacks, inline queries), spread across many chats.
+Rendering and guessing are real, so highlight, silicon and guesslang must be installed.
+"""
+import copy
+import json
+import os
+import random
+import sys
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import wraps
+from threading import Lock, local as thread_local
+from time import monotonic, perf_counter, time
+from typing import Callable, List, Mapping
+
+import structlog
+from plumbum import local
+from telebot import apihelper
+from telebot.types import Update
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+import colorcodebot  # noqa: E402
+from colorcodebot import METRICS, ColorCodeBot, load_configs, percentile  # noqa: E402
+from fake_api import FakeBotAPI  # noqa: E402
+from webhook_latency import load_updates, report  # noqa: E402
+
+KINDS = ('private', 'group', 'callback', 'inline', 'command')
+
+
+class Stages:
+    """Collect how long each call to each instrumented stage took"""
+
+    def __init__(self):
+        self.seconds = defaultdict(list)
+        self.lock = Lock()
+
+    def timed(self, stage: Callable[..., str], original: Callable) -> Callable:
+        @wraps(original)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[stage(*args, **kwargs)].append(perf_counter() - start)
+
+        return wrapper
+
+
+def kind_of(update: Mapping) -> str:
+    if 'callback_query' in update:
+        return 'callback'
+    if 'inline_query' in update:
+        return 'inline'
+    message = update['message']
+    if message.get('text', '').startswith('/'):
+        return 'command'
+    return 'private' if message['chat']['type'] == 'private' else 'group'
+
+
+def synthesize(
+    recorded: List[Mapping], total: int, mix: Mapping[str, int], chats: int, unique: bool
+) -> List[tuple[str, Mapping]]:
+    """
+    Return a stream of (kind, update) in random order, drawn from recorded templates,
+    each from one of a number of users/chats.
+    If unique, private snippets are varied so renders can't be served from a cache.
+    """
+    templates = defaultdict(list)
+    for update in recorded:
+        templates[kind_of(update)].append(update)
+    kinds = [kind for kind in mix if templates[kind]]
+    weights = [mix[kind] for kind in kinds]
+    stream = []
+    for update_id in range(1, total + 1):
+        kind = random.choices(kinds, weights)[0]
+        update = copy.deepcopy(random.choice(templates[kind]))
+        update['update_id'] = update_id
+        user_id = 1000 + random.randrange(chats)
+        body = next(v for k, v in update.items() if k != 'update_id')
+        body['from']['id'] = user_id
+        message = body.get('message', body if 'chat' in body else None)
+        if message:
+            if message['chat']['type'] == 'private':
+                message['chat']['id'] = user_id
+            else:
+                message['chat']['id'] = -100000 - user_id
+            snippet = message.get('reply_to_message', message)
+            snippet['chat'] = message['chat']
+            snippet['from'] = body['from']
+            if unique and kind in ('private', 'callback'):
+                snippet['text'] += f"\n# {update_id}"
+        stream.append((kind, update))
+    return stream
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--updates',
+        default=str(local.path(__file__).up() / 'updates.jsonl'),
+        help="JSON lines file of recorded updates (default: %(default)s)",
+    )
+    parser.add_argument('--total', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument(
+        '--mix',
+        default='private=4,group=3,callback=2,inline=1,command=0',
+        help="relative weights of update kinds (default: %(default)s)",
+    )
+    parser.add_argument(
+        '--unique', action='store_true', help="vary snippets to defeat render caches"
+    )
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log', default=os.devnull, help="bot log file (default: none)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    mix = {
+        kind: int(weight)
+        for kind, weight in (pair.split('=') for pair in args.mix.split(','))
+    }
+    stream = synthesize(
+        load_updates(args.updates), args.total, mix, args.chats, args.unique
+    )
+
+    api = FakeBotAPI(
+        args.latency, args.jitter, args.flood_rate, args.retry_after
+    ).start()
+    cfg = load_configs()
+    cfg['tuning']['transport']['api url'] = api.url
+
+    with local.tempdir() as folder:
+        ccb = ColorCodeBot(
+            api_key='123456:fake',
+            lang=cfg['lang'],
+            theme_image_ids=cfg['theme_image_ids'],
+            keyboards=cfg['kb'],
+            guesslang_syntaxes=cfg['guesslang'],
+            tuning=cfg['tuning'],
+            db_path=str(folder / 'bench.sqlite'),
+            threaded=False,
+        )
+        structlog.configure(
+            logger_factory=structlog.PrintLoggerFactory(open(args.log, 'a'))
+        )
+        ccb.guess_service.ready.result()
+
+        stages = Stages()
+        colorcodebot.run_renderer = stages.timed(
+            lambda cmd, *a, **kw: 'silicon' if 'silicon' in str(cmd) else 'highlight',
+            colorcodebot.run_renderer,
+        )
+        ccb.model_guess_ext = stages.timed(
+            lambda *a, **kw: 'guesslang', ccb.model_guess_ext
+        )
+        ccb.png_optimizer.optimize = stages.timed(
+            lambda *a, **kw: 'optimize', ccb.png_optimizer.optimize
+        )
+        apihelper.CUSTOM_REQUEST_SENDER = stages.timed(
+            lambda *a, files=None, **kw: 'upload' if files else 'api',
+            apihelper.CUSTOM_REQUEST_SENDER,
+        )
+
+        # Handlers may only queue their work, so wait for what they queue:
+        admitted = thread_local()
+        submit = ccb.admission.submit
+
+        def submit_and_track(*args, **kwargs):
+            future = submit(*args, **kwargs)
+            if future:
+                admitted.futures.append(future)
+            return future
+
+        ccb.admission.submit = submit_and_track
+        latencies = defaultdict(list)
+
+        def handle(item: tuple[str, Mapping]):
+            kind, update = item
+            if 'message' in update:
+                update['message']['date'] = int(time())
+                api.remember(update['message'])
+            admitted.futures = []
+            start = monotonic()
+            ccb.bot.process_new_updates([Update.de_json(json.dumps(update))])
+            for future in admitted.futures:
+                with suppress(Exception):
+                    future.result()
+            latencies[kind].append(monotonic() - start)
+
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as workers:
+            list(workers.map(handle, stream))
+        elapsed = monotonic() - start
+
+        for kind in KINDS:
+            if latencies[kind]:
+                report(kind, latencies[kind])
+        report('all', [s for seconds in latencies.values() for s in seconds])
+        print(f"{'throughput':>12}: {len(stream) / elapsed:.1f} updates/s")
+        for stage, seconds in sorted(stages.seconds.items()):
+            print(
+                f"{stage:>12}: total={sum(seconds):.2f}s"
+                f" p50={percentile(seconds, 50) * 1000:.1f}ms"
+                f" p95={percentile(seconds, 95) * 1000:.1f}ms n={len(seconds)}"
+            )
+        admissions = {
+            name: count
+            for name, count in METRICS.summary()['counters'].items()
+            if name.startswith('ccb_admissions_total')
+        }
+        print(f"{'admission':>12}: {json.dumps(admissions)}")
+        print(f"{'fake api':>12}: {json.dumps(api.stats())}")
+        api.shutdown()
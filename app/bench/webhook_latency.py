@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Post recorded updates to a webhook server and report latency percentiles.
+
+Unless --url is given, a local WebhookServer is started, whose processing step
+only records when each update was handed to it, so no network access or token is needed.
+Its "handoff" latency covers the server's own overhead (HTTP parsing, the secret check,
+queueing and decoding) but not handling; replay.py times the real handlers.
+"""
+import json
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import monotonic, sleep
+from typing import List, Mapping
+
+import requests
+from plumbum import local
+
+sys.path.insert(0, str(local.path(__file__).up(2)))
+
+from colorcodebot import WebhookServer, percentile  # noqa: E402
+
+SECRET = 'bench-secret'
+
+
+def load_updates(path: str) -> List[Mapping]:
+    return [json.loads(line) for line in local.path(path).read().splitlines() if line]
+
+
+def report(name: str, seconds: List[float]):
+    print(
+        f"{name:>12}: n={len(seconds)}"
+        + ''.join(
+            f" p{pct}={percentile(seconds, pct) * 1000:.2f}ms" for pct in (50, 95, 99)
+        )
+    )
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--updates',
+        default=str(local.path(__file__).up() / 'updates.jsonl'),
+        help="JSON lines file of recorded updates (default: %(default)s)",
+    )
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--url', help="post to this server instead of a local one")
+    parser.add_argument('--secret', default=SECRET)
+    args = parser.parse_args()
+
+    sent, handled = {}, {}
+    server = None
+    url = args.url
+    if not url:
+
+        def record(updates):
+            for update in updates:
+                handled[update.update_id] = monotonic()
+
+        server = WebhookServer(record, args.secret, port=0, path='/bench')
+        url = f"http://127.0.0.1:{server.httpd.server_port}/bench"
+        Thread(target=server.serve_forever, daemon=True).start()
+
+    recorded = load_updates(args.updates)
+    session = requests.Session()
+    session.mount(
+        'http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    )
+
+    def post(update_id: int) -> float:
+        update = {**recorded[update_id % len(recorded)], 'update_id': update_id}
+        sent[update_id] = start = monotonic()
+        session.post(
+            url,
+            json=update,
+            headers={'X-Telegram-Bot-Api-Secret-Token': args.secret},
+        ).raise_for_status()
+        return monotonic() - start
+
+    total = len(recorded) * args.rounds
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as clients:
+        acks = list(clients.map(post, range(total)))
+    report('ack', acks)
+
+    if server:
+        while len(handled) < total:
+            sleep(0.01)
+        elapsed = monotonic() - start
+        report('handoff', [handled[i] - sent[i] for i in range(total)])
+        print(f"{'throughput':>12}: {total / elapsed:.1f} updates/s")
+        server.shutdown()
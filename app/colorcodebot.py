@@ -1,68 +1,303 @@
 #!/usr/bin/env python3
+import asyncio
 import functools
+import hmac
 import io
+import json
 import os
-from contextlib import suppress
-from threading import Thread
-from time import sleep
-from typing import Any, Callable, Iterable, List, Mapping, Optional, TypedDict, Union
+import random
+import re
+import struct
+import sys
+from argparse import ArgumentParser
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from hashlib import sha256
+from heapq import heappop, heappush
+from html import escape as escape_html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from operator import itemgetter
+from queue import Empty, Full, Queue
+from threading import (
+    Condition, Event, Lock, Thread, active_count, enumerate as all_threads, get_ident
+)
+from time import monotonic, sleep, time
+from types import FrameType
+from typing import (
+    TYPE_CHECKING, Any, Callable, Iterable, Iterator,
+    List, Mapping, Optional, TypedDict, Union
+)
 from uuid import uuid4
 
+import requests
 import strictyaml
 import structlog
-from guesslang import Guess
-from peewee import BooleanField, CharField, IntegerField
+from peewee import BooleanField, CharField, FloatField, IntegerField, OperationalError
 from playhouse.kv import KeyValue
 from playhouse.sqliteq import SqliteQueueDatabase as SqliteDatabase
-from plumbum import local
+from plumbum import CommandNotFound, local
 from plumbum.cmd import highlight, silicon
+from plumbum.commands.base import BoundCommand
+from plumbum.machines import LocalCommand
+from plumbum.path.local import LocalPath
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 from structlog.types import BindableLogger
-from telebot import TeleBot
-from telebot.apihelper import ApiException
+from telebot import TeleBot, apihelper
+from telebot.apihelper import ApiException, ApiTelegramException
 from telebot.types import (
-    CallbackQuery, ForceReply, InlineKeyboardButton, InlineKeyboardMarkup,
-    InlineQuery, InlineQueryResultCachedPhoto, InputMediaPhoto, Message
+    CallbackQuery, Chat, ChatMemberUpdated, Document, ForceReply, InlineKeyboardButton,
+    InlineKeyboardMarkup, InlineQuery, InlineQueryResultCachedPhoto,
+    InputMediaDocument, InputMediaPhoto, JsonSerializable, Message, Update
 )
 from wrapt import decorator
 
+if TYPE_CHECKING:
+    from guesslang import Guess
+
 WraptFunc = Callable[[Callable, Any, Iterable, Mapping], Callable]
 
 
 class Config(TypedDict):
     lang: Mapping[str, str]
     theme_image_ids: tuple[str]
-    kb: Mapping[str, InlineKeyboardMarkup]
+    kb: Mapping[str, 'FrozenMarkup']
     guesslang: Mapping[str, str]
+    tuning: Mapping[str, Mapping[str, Union[int, float]]]
 
 
-def yload(yamltxt: str) -> Union[str, List, Mapping]:
-    return strictyaml.load(yamltxt).data
+TUNING_SCHEMA = strictyaml.Map(
+    {
+        'render cache': strictyaml.Map(
+            {
+                'max entries': strictyaml.Int(),
+                'max bytes': strictyaml.Int(),
+                'max age seconds': strictyaml.Float(),
+            }
+        ),
+        'render pool': strictyaml.Map(
+            {
+                'workers': strictyaml.Int(),
+                'queue size': strictyaml.Int(),
+                'timeout seconds': strictyaml.Float(),
+            }
+        ),
+        'png optimizer': strictyaml.Map(
+            {
+                strictyaml.Optional('quantize quality'): strictyaml.Str(),
+                strictyaml.Optional('recompress level'): strictyaml.Int(),
+                'timeout seconds': strictyaml.Float(),
+            }
+        ),
+        'paging': strictyaml.Map(
+            {
+                'max lines per page': strictyaml.Int(),
+                'max bytes per page': strictyaml.Int(),
+                'max pages': strictyaml.Int(),
+                'max document bytes': strictyaml.Int(),
+                'download chunk bytes': strictyaml.Int(),
+            }
+        ),
+        'pipeline': strictyaml.Map(
+            {
+                'workers': strictyaml.Int(),
+                'deadline seconds': strictyaml.Float(),
+            }
+        ),
+        'guess batching': strictyaml.Map(
+            {
+                'batch size': strictyaml.Int(),
+                'max wait seconds': strictyaml.Float(),
+            }
+        ),
+        'guess cache': strictyaml.Map({'max entries': strictyaml.Int()}),
+        'settings cache': strictyaml.Map(
+            {
+                'max entries': strictyaml.Int(),
+                strictyaml.Optional('sharded ttl seconds'): strictyaml.Float(),
+            }
+        ),
+        'file id cache': strictyaml.Map({'max entries': strictyaml.Int()}),
+        'admin cache': strictyaml.Map(
+            {'max chats': strictyaml.Int(), 'ttl seconds': strictyaml.Float()}
+        ),
+        'guesslang': strictyaml.Map({'ready wait seconds': strictyaml.Float()}),
+        'deletions': strictyaml.Map(
+            {
+                'delay seconds': strictyaml.Float(),
+                'attempts': strictyaml.Int(),
+                'retry seconds': strictyaml.Float(),
+            }
+        ),
+        'async': strictyaml.Map({'concurrency': strictyaml.Int()}),
+        'transport': strictyaml.Map(
+            {
+                'pool size': strictyaml.Int(),
+                'keep alive': strictyaml.Bool(),
+                'connect timeout seconds': strictyaml.Float(),
+                'read timeout seconds': strictyaml.Float(),
+                'upload timeout seconds': strictyaml.Float(),
+                'flood control waits': strictyaml.Int(),
+                'max flood wait seconds': strictyaml.Float(),
+                strictyaml.Optional('api url'): strictyaml.Str(),
+            }
+        ),
+        'rate limits': strictyaml.Map(
+            {
+                'global per second': strictyaml.Float(),
+                'global burst': strictyaml.Int(),
+                'private chat per second': strictyaml.Float(),
+                'private chat burst': strictyaml.Int(),
+                'group chat per minute': strictyaml.Float(),
+                'group chat burst': strictyaml.Int(),
+                'max chats': strictyaml.Int(),
+                'chat action seconds': strictyaml.Float(),
+            }
+        ),
+        'webhook': strictyaml.Map(
+            {
+                'host': strictyaml.Str(),
+                'port': strictyaml.Int(),
+                'path': strictyaml.Str(),
+                'queue size': strictyaml.Int(),
+            }
+        ),
+        'metrics': strictyaml.Map(
+            {
+                'host': strictyaml.Str(),
+                strictyaml.Optional('port'): strictyaml.Int(),
+                strictyaml.Optional('log interval seconds'): strictyaml.Float(),
+            }
+        ),
+        'profiler': strictyaml.Map(
+            {
+                'interval seconds': strictyaml.Float(),
+                'default seconds': strictyaml.Float(),
+                'max seconds': strictyaml.Float(),
+            }
+        ),
+        'admission': strictyaml.Map(
+            {
+                'workers': strictyaml.Int(),
+                'max age seconds': strictyaml.Float(),
+                'shed latency seconds': strictyaml.Float(),
+                'group jobs per minute': strictyaml.Float(),
+                'group burst': strictyaml.Int(),
+                'max groups': strictyaml.Int(),
+            }
+        ),
+        'sharding': strictyaml.Map(
+            {
+                'workers': strictyaml.Int(),
+                'host': strictyaml.Str(),
+                'base port': strictyaml.Int(),
+                'path': strictyaml.Str(),
+                'poll timeout seconds': strictyaml.Int(),
+                'queue size': strictyaml.Int(),
+            }
+        ),
+    }
+)
+
+
+def yload(
+    yamltxt: str, schema: Optional[strictyaml.Validator] = None
+) -> Union[str, List, Mapping]:
+    return strictyaml.load(yamltxt, schema).data
 
 
 def ydump(data: Mapping) -> str:
     return strictyaml.as_document(data).as_yaml()
 
 
-BEGONE_BUTTON = InlineKeyboardButton('🗑️', callback_data=ydump({'action': 'begone'}))
+CALLBACK_VERSION = '2'
+
+# fmt: off
+CALLBACK_ACTIONS = {
+    # action:              (code, fields)
+    'begone':              ('b', ()),
+    'restore':             ('r', ('kb_name',)),
+    'set ext':             ('x', ('ext',)),
+    'set default ext':     ('d', ('ext',)),
+    'browse group syntax': ('g', ()),
+    'toggle watch mode':   ('w', ()),
+    'set theme':           ('t', ('theme',)),
+}
+# fmt: on
+
+CALLBACK_CODES = {
+    code: (action, fields) for action, (code, fields) in CALLBACK_ACTIONS.items()
+}
+
+
+def cbdump(data: Mapping[str, str]) -> str:
+    """Return compact callback data: version|action code|field values..."""
+    code, fields = CALLBACK_ACTIONS[data['action']]
+    return '|'.join((CALLBACK_VERSION, code, *(data[field] for field in fields)))
+
+
+@functools.lru_cache(maxsize=1024)
+def cbload(payload: str) -> Mapping[str, str]:
+    """
+    Decode callback data, whether compact or YAML (as on older messages).
+    The result is cached and shared, so don't modify it.
+    """
+    version, _, rest = payload.partition('|')
+    if version != CALLBACK_VERSION:
+        return yload(payload)
+    action, fields = CALLBACK_CODES[rest[:1]]
+    values = rest[2:].split('|', len(fields) - 1) if fields else ()
+    return {'action': action, **dict(zip(fields, values))}
+
+
+BEGONE_BUTTON = InlineKeyboardButton('🗑️', callback_data=cbdump({'action': 'begone'}))
+
+FILE_ID_PLACEHOLDER = '@FILE_ID@'
+
+
+class FrozenMarkup(JsonSerializable):
+    """
+    A reply markup serialized just once, which pyTelegramBotAPI sends as is.
+    Any placeholder string values can be filled in per use with splice.
+    """
+
+    def __init__(self, markup: Union[InlineKeyboardMarkup, str]):
+        self.json = markup if isinstance(markup, str) else markup.to_json()
+
+    def to_json(self) -> str:
+        return self.json
+
+    def splice(self, placeholder: str, value: str) -> 'FrozenMarkup':
+        return FrozenMarkup(self.json.replace(placeholder, json.dumps(value)[1:-1]))
+
 
 BEGONE_KB = InlineKeyboardMarkup()
 BEGONE_KB.add(BEGONE_BUTTON)
+BEGONE_KB = FrozenMarkup(BEGONE_KB)
 
 BG_IMAGE = str(local.path(__file__).up() / 'sharon-mccutcheon-33xSu0EWgP4-unsplash.jpg')
 
 
-def is_from_group_admin_or_creator(bot, message_or_query: Union[Message, CallbackQuery]):
+ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query', 'chat_member']
+
+
+def is_from_group_admin_or_creator(
+    admins: 'AdminCache', message_or_query: Union[Message, CallbackQuery]
+):
     if isinstance(message_or_query, Message):
         message = message_or_query
-        return message.chat.type == 'private' or bot.get_chat_member(
+        return message.chat.type == 'private' or admins.is_admin(
             message.chat.id, message.from_user.id
-        ).status in ('administrator', 'creator')
+        )
     elif isinstance(message_or_query, CallbackQuery):
         query = message_or_query
-        return query.message.chat.type == 'private' or bot.get_chat_member(
+        return query.message.chat.type == 'private' or admins.is_admin(
             query.message.chat.id, query.from_user.id
-        ).status in ('administrator', 'creator')
+        )
 
 
 def load_configs() -> Config:
@@ -76,11 +311,15 @@ def load_configs() -> Config:
 
     data['theme_image_ids'] = tuple(theme_names_ids.values())
 
+    data['tuning'] = yload(
+        (local.path(__file__).up() / 'tuning.yml').read(), TUNING_SCHEMA
+    )
+
     kb_theme = InlineKeyboardMarkup()
     kb_theme.add(
         *[
             InlineKeyboardButton(
-                name, callback_data=ydump({'action': 'set theme', 'theme': name})
+                name, callback_data=cbdump({'action': 'set theme', 'theme': name})
             )
             for name in theme_names_ids.keys()
         ],
@@ -91,7 +330,7 @@ def load_configs() -> Config:
     kb_syntax.add(
         *[
             InlineKeyboardButton(
-                name, callback_data=ydump({'action': 'set ext', 'ext': ext})
+                name, callback_data=cbdump({'action': 'set ext', 'ext': ext})
             )
             for name, ext in syntax_names_exts.items()
         ],
@@ -102,12 +341,12 @@ def load_configs() -> Config:
     kb_group_syntax.add(
         *[
             InlineKeyboardButton(
-                name, callback_data=ydump({'action': 'set default ext', 'ext': ext})
+                name, callback_data=cbdump({'action': 'set default ext', 'ext': ext})
             )
             for name, ext in syntax_names_exts.items()
         ],
         InlineKeyboardButton(
-            "None", callback_data=ydump({'action': 'set default ext', 'ext': ''})
+            "None", callback_data=cbdump({'action': 'set default ext', 'ext': ''})
         ),
         BEGONE_BUTTON,
     )
@@ -116,85 +355,1155 @@ def load_configs() -> Config:
     kb_group_options.add(
         InlineKeyboardButton(
             data['lang']['select default syntax'],
-            callback_data=ydump({'action': 'browse group syntax'}),
+            callback_data=cbdump({'action': 'browse group syntax'}),
         ),
         InlineKeyboardButton(
             data['lang']['toggle watch mode'],
-            callback_data=ydump({'action': 'toggle watch mode'}),
+            callback_data=cbdump({'action': 'toggle watch mode'}),
         ),
         BEGONE_BUTTON,
     )
 
+    kb_image_send = InlineKeyboardMarkup()
+    kb_image_send.add(
+        InlineKeyboardButton(
+            data['lang']['send to chat'],
+            switch_inline_query=f"img {FILE_ID_PLACEHOLDER}",
+        )
+    )
+    kb_image_send.add(BEGONE_BUTTON)
+
     data['kb'] = {
-        'theme': kb_theme,
-        'syntax': kb_syntax,
-        'group options': kb_group_options,
-        'group syntax': kb_group_syntax,
+        name: FrozenMarkup(kb)
+        for name, kb in {
+            'theme': kb_theme,
+            'syntax': kb_syntax,
+            'group options': kb_group_options,
+            'group syntax': kb_group_syntax,
+            'image send': kb_image_send,
+        }.items()
     }
 
     return data
 
 
-def mk_html(code: str, ext: str, theme: str = 'base16/bright') -> str:
-    """Return generated HTML content"""
-    return (
-        highlight[
-            f"--syntax={ext}",
-            f"--style={theme}",
-            '--line-numbers',
-            '--out-format=html',
-            '--include-style',
-            '--encoding=UTF-8',
-            (
-                '--font=ui-monospace,monospace,mono'
-                ',monaco'
-                ',Consolas'
-                ',Andale Mono,AndaleMono'
-                ',Lucida Console'
-                ',Lucida Sans Typewriter'
-                ',Lucida Typewriter'
-                ',Courier New'
-                ',Courier'
-                ',Bitstream Vera Sans Mono'
-            ),
+HIGHLIGHT_FLAGS = (
+    '--line-numbers',
+    '--out-format=html',
+    '--include-style',
+    '--encoding=UTF-8',
+    (
+        '--font=ui-monospace,monospace,mono'
+        ',monaco'
+        ',Consolas'
+        ',Andale Mono,AndaleMono'
+        ',Lucida Console'
+        ',Lucida Sans Typewriter'
+        ',Lucida Typewriter'
+        ',Courier New'
+        ',Courier'
+        ',Bitstream Vera Sans Mono'
+    ),
+)
+
+# fmt: off
+SILICON_FLAGS = (
+    '--pad-horiz', '20',
+    '--pad-vert', '25',
+    '--shadow-blur-radius', '5',
+    '--background-image', BG_IMAGE,
+    '-f', '; '.join((
+        'Iosevka Term Custom',
+        'Symbols Nerd Font',
+        'NanumGothicCoding',
+        'OpenMoji',
+    )),
+)
+# fmt: on
+
+RENDERERS = {
+    'highlight': (highlight, HIGHLIGHT_FLAGS),
+    'silicon': (silicon, SILICON_FLAGS),
+}
+
+
+def percentile(values: Iterable[float], pct: float) -> Optional[float]:
+    values = sorted(values)
+    if values:
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRIC_HELP = {
+    'ccb_stage_seconds': "Time spent in each stage of handling code (stages may nest)",
+    'ccb_api_seconds': "Time taken by Bot API requests, by method",
+    'ccb_rate_limit_wait_seconds': "Time outbound messages waited on the rate limiter",
+    'ccb_render_wait_seconds': "Time render jobs waited in the queue for a worker",
+    'ccb_deletion_lag_seconds': "Time between a deletion falling due and its attempt",
+    'ccb_guesses_total': "Syntax guesses, by the step that decided them",
+    'ccb_guess_batches_total': "Batched guesslang model calls",
+    'ccb_guess_batch_snippets_total': "Snippets guessed by batched guesslang model calls",
+    'ccb_retries_total': "Failed attempts of retry-able calls, by function and cause",
+    'ccb_retries_exhausted_total': "Calls that failed every attempt, by function",
+    'ccb_deletions_total': "Attempted message deletions, by outcome",
+    'ccb_deletion_backlog': "Messages waiting to be deleted",
+    'ccb_render_queue_depth': "Render jobs waiting for a worker",
+    'ccb_webhook_queue_depth': "Received updates waiting to be processed",
+    'ccb_webhook_updates_total': "Webhook updates, by outcome",
+    'ccb_forward_queue_depth': "Updates waiting to be forwarded to each worker",
+    'ccb_forward_dropped_total': "Updates dropped because a worker's queue was full",
+    'ccb_admissions_total': "Code handling jobs, by priority and outcome",
+    'ccb_admission_wait_seconds': "Time code handling jobs waited to run, by priority",
+    'ccb_admission_queue_depth': "Code handling jobs waiting to run",
+}
+
+
+def prometheus_labels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'),
+        )
+        for name, value in labels
+    )
+    return f"{{{pairs}}}" if pairs else ''
+
+
+class Histogram:
+    """Count observations into buckets by upper bound, with a running sum"""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def quantile(self, pct: float) -> Optional[float]:
+        """
+        Return the upper bound of the bucket the percentile falls in,
+        or None if it's beyond the last bucket, or nothing's been observed
+        """
+        total = sum(self.counts)
+        seen = 0
+        for bound, hits in zip(self.buckets, self.counts):
+            seen += hits
+            if seen and seen >= total * pct / 100:
+                return bound
+
+
+class Metrics:
+    """
+    Named and labeled counters, latency histograms, and gauges (read when reported),
+    rendered in Prometheus' text format, or summarized for logging.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.gauges: dict[tuple[str, tuple], Callable[[], float]] = {}
+        self.lock = Lock()
+
+    def count(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    def gauge(self, name: str, read: Callable[[], float], **labels: str):
+        """Report the result of calling read, whenever metrics are collected"""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = read
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started, **labels)
+
+    def timed(self, name: str, **labels: str) -> WraptFunc:
+        """Decorate a function to observe how long each call takes"""
+
+        @decorator
+        def wrapper(original, instance, args, kwargs):
+            with self.timer(name, **labels):
+                return original(*args, **kwargs)
+
+        return wrapper
+
+    def collect(
+        self,
+    ) -> tuple[dict[tuple, float], dict[tuple, float], dict[tuple, Histogram]]:
+        """Return copies of the counters, current gauge values, and histograms"""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[key] = Histogram(histogram.buckets)
+                histograms[key].counts = histogram.counts[:]
+                histograms[key].sum = histogram.sum
+        gauge_values = {}
+        for key, read in gauges.items():
+            with suppress(Exception):
+                gauge_values[key] = read()
+        return counters, gauge_values, histograms
+
+    def exposition(self) -> str:
+        """Return all metrics in Prometheus' text format"""
+        counters, gauges, histograms = self.collect()
+        lines = []
+        for kind, series in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{prometheus_labels(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in sorted(
+                histograms.items(), key=itemgetter(0)
+            ):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, hits in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                    cumulative += hits
+                    le = prometheus_labels((*labels, ('le', bound)))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{prometheus_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{prometheus_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """
+        Return counters and gauges, and each histogram's count, mean,
+        and approximate (bucket bound) median and 95th percentile
+        """
+        counters, gauges, histograms = self.collect()
+        return {
+            'counters': {
+                f"{name}{prometheus_labels(labels)}": value
+                for (name, labels), value in sorted(counters.items())
+            },
+            'gauges': {
+                f"{name}{prometheus_labels(labels)}": value
+                for (name, labels), value in sorted(gauges.items())
+            },
+            'histograms': {
+                f"{name}{prometheus_labels(labels)}": {
+                    'count': sum(histogram.counts),
+                    'mean': histogram.sum / sum(histogram.counts),
+                    'p50': histogram.quantile(50),
+                    'p95': histogram.quantile(95),
+                }
+                for (name, labels), histogram in sorted(
+                    histograms.items(), key=itemgetter(0)
+                )
+            },
+        }
+
+
+METRICS = Metrics()
+
+
+class MetricsExporter:
+    """
+    Serve metrics in Prometheus' text format at http://host:port/metrics,
+    and/or log a summary of them every log_interval seconds.
+    """
+
+    def __init__(
+        self,
+        metrics: Metrics,
+        host: str = '127.0.0.1',
+        port: Optional[int] = None,
+        log_interval: Optional[float] = None,
+        log: Optional[BindableLogger] = None,
+    ):
+        self.metrics = metrics
+        self.log_interval = log_interval
+        self.log = log
+        self.threads = []
+        if port is not None:
+            self.httpd = ThreadingHTTPServer((host, port), self.mk_request_handler())
+            self.threads.append(
+                Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+            )
+        if log_interval and log:
+            self.threads.append(
+                Thread(target=self._log_summaries, name='metrics-log', daemon=True)
+            )
+
+    def mk_request_handler(self) -> type[BaseHTTPRequestHandler]:
+        exporter = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    return self.send_error(404)
+                body = exporter.metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsRequestHandler
+
+    def _log_summaries(self):
+        while True:
+            sleep(self.log_interval)
+            self.log.msg("metrics summary", **self.metrics.summary())
+
+    def start(self) -> 'MetricsExporter':
+        for thread in self.threads:
+            thread.start()
+        return self
+
+
+def rss_bytes() -> Optional[int]:
+    """Return this process' resident set size, if /proc reports it"""
+    with suppress(OSError, ValueError), open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def collapse_stack(thread_name: str, frame: FrameType) -> str:
+    """Return the stack as one line of semicolon-separated frames, outermost first"""
+    frames = []
+    while frame:
+        code = frame.f_code
+        frames.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ';'.join((thread_name, *reversed(frames)))
+
+
+class SamplingProfiler:
+    """
+    Sample every thread's stack at an interval, from a background thread,
+    for a set time or until stopped, then pass the counted stacks to a callback,
+    in the collapsed format read by flamegraph.pl, inferno, and speedscope.
+    Sampling is by wall clock, so idle threads show up waiting.
+    Only one profile runs at a time.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stopping = Event()
+        self.running = False
+        self.lock = Lock()
+
+    def start(self, seconds: float, done: Callable[[str, int], Any]) -> bool:
+        """Start profiling, unless already running, and return whether it started"""
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.stopping.clear()
+        Thread(
+            target=self._sample, args=(seconds, done), name='profiler', daemon=True
+        ).start()
+        return True
+
+    def stop(self) -> bool:
+        """End the running profile early, and return whether one was running"""
+        with self.lock:
+            if self.running:
+                self.stopping.set()
+            return self.running
+
+    def _sample(self, seconds: float, done: Callable[[str, int], Any]):
+        stacks = Counter()
+        samples = 0
+        deadline = monotonic() + seconds
+        try:
+            while monotonic() < deadline and not self.stopping.wait(self.interval):
+                names = {thread.ident: thread.name for thread in all_threads()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != get_ident():
+                        stacks[collapse_stack(names.get(ident, str(ident)), frame)] += 1
+                samples += 1
+        finally:
+            with self.lock:
+                self.running = False
+        done(
+            ''.join(f"{stack} {hits}\n" for stack, hits in stacks.most_common()),
+            samples,
+        )
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderPool:
+    """
+    Run renderer subprocesses on a fixed set of long-lived worker threads,
+    fed by a bounded queue, with a timeout per job.
+
+    Neither highlight nor silicon can serve more than one job per process,
+    so the pool caps concurrent renders rather than reusing processes.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 32, timeout: float = 30):
+        self.timeout = timeout
+        self.jobs = Queue(maxsize=queue_size)
+        self.waits = deque(maxlen=256)
+        self.latencies = deque(maxlen=256)
+        self.rendered = 0
+        self.failed = 0
+        self.lock = Lock()
+        self.workers = [
+            Thread(target=self._work, name=f'render-{i}', daemon=True)
+            for i in range(workers)
         ]
-        << code
-    )()
+        for worker in self.workers:
+            worker.start()
+        METRICS.gauge('ccb_render_queue_depth', self.jobs.qsize)
+
+    def submit(self, cmd: BoundCommand, stdin: str) -> Future:
+        """Queue a command to be fed stdin, returning a future of its stdout"""
+        future = Future()
+        try:
+            self.jobs.put((cmd, stdin, future, monotonic()), timeout=self.timeout)
+        except Full:
+            raise RenderQueueFull(f"{self.jobs.maxsize} renders already queued")
+        return future
+
+    def run(self, cmd: BoundCommand, stdin: str) -> str:
+        return self.submit(cmd, stdin).result()
+
+    def _work(self):
+        while True:
+            cmd, stdin, future, queued = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = monotonic()
+            try:
+                _, stdout, _ = (cmd << stdin).run(timeout=self.timeout)
+            except Exception as e:
+                future.set_exception(e)
+                with self.lock:
+                    self.failed += 1
+            else:
+                future.set_result(stdout)
+                with self.lock:
+                    self.rendered += 1
+            with self.lock:
+                self.waits.append(started - queued)
+                self.latencies.append(monotonic() - started)
+            METRICS.observe('ccb_render_wait_seconds', started - queued)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'rendered': self.rendered,
+                'failed': self.failed,
+                'wait_p50': percentile(self.waits, 50),
+                'wait_p95': percentile(self.waits, 95),
+                'latency_p50': percentile(self.latencies, 50),
+                'latency_p95': percentile(self.latencies, 95),
+                'latency_max': max(self.latencies, default=None),
+            }
+
+
+def run_renderer(
+    cmd: BoundCommand, stdin: str, pool: Optional[RenderPool] = None
+) -> str:
+    """Run the command directly, or as a job in the pool if one is provided"""
+    return pool.run(cmd, stdin) if pool else (cmd << stdin)()
+
+
+def mk_html(
+    code: str, ext: str, theme: str = 'base16/bright', pool: Optional[RenderPool] = None
+) -> str:
+    """Return generated HTML content"""
+    with METRICS.timer('ccb_stage_seconds', stage='highlight'):
+        return run_renderer(
+            highlight[f"--syntax={ext}", f"--style={theme}", HIGHLIGHT_FLAGS], code, pool
+        )
+
+
+def mk_html_file(
+    path: LocalPath,
+    ext: str,
+    theme: str = 'base16/bright',
+    pool: Optional[RenderPool] = None,
+) -> str:
+    """Return generated HTML content for a whole file, read by highlight from disk"""
+    with METRICS.timer('ccb_stage_seconds', stage='highlight'):
+        return run_renderer(
+            highlight[
+                f"--input={path}", f"--syntax={ext}", f"--style={theme}", HIGHLIGHT_FLAGS
+            ],
+            '',
+            pool,
+        )
 
 
-def mk_png(code: str, ext: str, theme: str = 'Coldark-Dark', folder=None) -> str:
-    """Return generated PNG file path"""
-    folder = (local.path(folder) if folder else local.path('/tmp/ccb_png')) / uuid4()
+@functools.cache
+def scratch_folder(name: str) -> LocalPath:
+    """Return a folder for short-lived files, on a tmpfs if available"""
+    shm = local.path('/dev/shm')
+    folder = (shm if shm.is_dir() else local.path('/tmp')) / name
     folder.mkdir()
+    return folder
 
+
+def optional_command(name: str) -> Optional[LocalCommand]:
+    try:
+        return local[name]
+    except CommandNotFound:
+        return None
+
+
+class PngOptimizer:
+    """
+    Shrink PNG files in place, with lossy palette quantization (pngquant)
+    and/or lossless recompression (oxipng), whichever of them are installed.
+    """
+
+    def __init__(
+        self,
+        quantize_quality: Optional[str] = '65-90',
+        recompress_level: Optional[int] = 2,
+        timeout: float = 30,
+    ):
+        self.timeout = timeout
+        self.steps = []
+        pngquant = optional_command('pngquant') if quantize_quality else None
+        if pngquant:
+            # 98: result would be larger, 99: quality would be below the minimum
+            self.steps.append(
+                (
+                    'pngquant',
+                    pngquant[
+                        f"--quality={quantize_quality}",
+                        '--skip-if-larger',
+                        '--force',
+                        '--ext=.png',
+                        '--strip',
+                    ],
+                    (0, 98, 99),
+                )
+            )
+        oxipng = optional_command('oxipng') if recompress_level is not None else None
+        if oxipng:
+            self.steps.append(
+                (
+                    'oxipng',
+                    oxipng[f"--opt={recompress_level}", '--strip=safe', '--quiet'],
+                    0,
+                )
+            )
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = Lock()
+
+    @METRICS.timed('ccb_stage_seconds', stage='optimize')
+    def optimize(self, png: LocalPath):
+        before = png.stat().st_size
+        for _, cmd, retcode in self.steps:
+            cmd[png].run(retcode=retcode, timeout=self.timeout)
+        with self.lock:
+            self.bytes_in += before
+            self.bytes_out += png.stat().st_size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'steps': [name for name, _, _ in self.steps],
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.bytes_out / self.bytes_in if self.bytes_in else None,
+            }
+
+
+def mk_png(
+    code: str,
+    ext: str,
+    theme: str = 'Coldark-Dark',
+    pool: Optional[RenderPool] = None,
+    optimizer: Optional[PngOptimizer] = None,
+    line_offset: int = 1,
+) -> bytes:
+    """Return generated PNG image data"""
     # TODO: test all ext values...
 
-    png = folder / f'{uuid4()}.png'
+    # silicon can only write to a file, whose extension determines the format,
+    # so it writes to memory-backed storage, and the file is gone once read:
+    png = scratch_folder('ccb_png') / f'{uuid4()}.png'
+    try:
+        cmd = silicon['-o', png, '-l', ext, '--theme', theme, SILICON_FLAGS]
+        with METRICS.timer('ccb_stage_seconds', stage='silicon'):
+            run_renderer(cmd[line_offset_flags(line_offset)], code, pool)
+        if optimizer:
+            optimizer.optimize(png)
+        return png.read(mode='rb')
+    finally:
+        png.delete()
+
+
+# Beyond these, Telegram rejects a photo, or compresses it illegibly,
+# so the image is sent as a document instead:
+PHOTO_MAX_BYTES = 300000
+PHOTO_MAX_SIDES = 10000
+PHOTO_MAX_ASPECT_RATIO = 20
+
+
+def png_dimensions(png: bytes) -> tuple[int, int]:
+    """Return the width and height from a PNG's IHDR chunk"""
+    return struct.unpack('>II', png[16:24])
+
+
+def fits_photo(png: bytes) -> bool:
+    """Predict whether Telegram will accept the image as a photo"""
+    if len(png) >= PHOTO_MAX_BYTES:
+        return False
+    width, height = png_dimensions(png)
+    long_side, short_side = max(width, height), min(width, height)
+    return (
+        width + height <= PHOTO_MAX_SIDES
+        and long_side <= PHOTO_MAX_ASPECT_RATIO * short_side
+    )
+
+
+@functools.cache
+def renderer_version(renderer: str) -> str:
+    """Return the first line of the named renderer's version output"""
+    cmd, _ = RENDERERS[renderer]
+    return cmd('--version').strip().splitlines()[0]
+
+
+def line_offset_flags(line_offset: int) -> tuple[str, ...]:
+    """Return silicon's flags to number lines from line_offset (none for the default)"""
+    return ('--line-offset', str(line_offset)) if line_offset != 1 else ()
+
+
+CODE_MIME_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/sql',
+    'application/toml',
+    'application/x-httpd-php',
+    'application/x-perl',
+    'application/x-ruby',
+    'application/x-sh',
+    'application/x-shellscript',
+    'application/x-yaml',
+    'application/xml',
+)
+
+
+# Openers and closers of block comments and long strings, by syntax.
+# Each page is highlighted on its own, so pages shouldn't start inside one.
+C_BLOCK_COMMENTS = {'/*': '*/'}
+BLOCK_DELIMITERS = {
+    **dict.fromkeys(
+        ('c', 'csharp', 'css', 'java', 'objc', 'php', 'qml', 'rust', 'sol', 'sql'),
+        C_BLOCK_COMMENTS,
+    ),
+    **dict.fromkeys(
+        ('dart', 'kotlin', 'scala', 'swift'), {**C_BLOCK_COMMENTS, '"""': '"""'}
+    ),
+    **dict.fromkeys(('go', 'js', 'ts'), {**C_BLOCK_COMMENTS, '`': '`'}),
     # fmt: off
-    (
-        silicon[
-            '-o', png,
-            '-l', ext,
-            '--theme', theme,
-            '--pad-horiz', 20,
-            '--pad-vert', 25,
-            '--shadow-blur-radius', 5,
-            '--background-image', BG_IMAGE,
-            '-f', '; '.join((
-                'Iosevka Term Custom',
-                'Symbols Nerd Font',
-                'NanumGothicCoding',
-                'OpenMoji',
-            ))
-        ]
-        << code
-    )()
+    'py3':  {'"""': '"""', "'''": "'''"},
+    'html': {'<!--': '-->'}, 'xml': {'<!--': '-->'},
+    'lua':  {'--[[': ']]'},
+    'hs':   {'{-': '-}'},
+    'nim':  {'#[': ']#'},
+    'ps1':  {'<#': '#>'},
     # fmt: on
+}
+# Quotes of ordinary (one line) string literals, whose contents can look like openers;
+# both single and double quotes, unless listed:
+STRING_QUOTES = {'html': '', 'xml': '', 'hs': '"', 'rust': '"'}
+BLOCK_OPENERS = {
+    ext: re.compile(
+        '|'.join(
+            (
+                *map(re.escape, delimiters),
+                *(rf"{q}(?:[^{q}\\\n]|\\.)*{q}" for q in STRING_QUOTES.get(ext, '"\'')),
+            )
+        )
+    )
+    for ext, delimiters in BLOCK_DELIMITERS.items()
+}
+
+
+def block_closer(line: str, ext: str, closer: Optional[str] = None) -> Optional[str]:
+    """
+    Return the closer of the block comment or long string left open after the line,
+    given the one left open before it, if any
+    """
+    if ext not in BLOCK_OPENERS:
+        return None
+    pos = 0
+    while True:
+        if closer:
+            end = line.find(closer, pos)
+            if end < 0:
+                return closer
+            pos, closer = end + len(closer), None
+        else:
+            opener = BLOCK_OPENERS[ext].search(line, pos)
+            if not opener:
+                return None
+            # A match that isn't a delimiter is a whole string literal, so skip it:
+            pos, closer = opener.end(), BLOCK_DELIMITERS[ext].get(opener.group())
+
+
+def paginate(
+    lines: Iterable[str],
+    ext: str,
+    max_lines: int = 80,
+    max_bytes: int = 8192,
+    max_pages: int = 10,
+) -> tuple[List[tuple[int, str]], bool]:
+    """
+    Split code into pages of whole lines, each within the line and byte limits
+    (unless a single line is over the byte limit).
+    Pages end after the last line outside any of the syntax's block comments
+    or long strings, if any.
+    Return each page's first line number and code, and whether any code was left out.
+    """
+    pages, page, page_bytes, first_line = [], [], 0, 1
+    closer, safe_lines = None, 0
+    for line in lines:
+        size = len(line.encode())
+        if page and (len(page) >= max_lines or page_bytes + size > max_bytes):
+            cut = safe_lines or len(page)
+            pages.append((first_line, ''.join(page[:cut]).rstrip('\n')))
+            if len(pages) >= max_pages:
+                return pages, True
+            page, first_line, safe_lines = page[cut:], first_line + cut, 0
+            page_bytes = sum(len(carried.encode()) for carried in page)
+        page.append(line)
+        page_bytes += size
+        closer = block_closer(line, ext, closer)
+        if not closer:
+            safe_lines = len(page)
+    if page:
+        pages.append((first_line, ''.join(page).rstrip('\n')))
+    return pages, False
+
+
+def render_key(renderer: str, code: str, ext: str, theme: str, *flags: str) -> str:
+    """
+    Return a content hash identifying a render,
+    covering the renderer's version and flags as well as the input.
+    """
+    _, renderer_flags = RENDERERS[renderer]
+    digest = sha256()
+    for part in (
+        renderer,
+        renderer_version(renderer),
+        *renderer_flags,
+        ext,
+        theme,
+        code,
+        *flags,
+    ):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+@dataclass
+class Render:
+    html: Optional[str] = None
+    png: Optional[bytes] = None
+    file_id: Optional[str] = None
+    file_kind: Optional[str] = None
+    created: float = field(default_factory=monotonic)
+
+    @property
+    def size(self) -> int:
+        return len(self.html.encode()) if self.html else len(self.png or b'')
+
+
+class RenderCache:
+    """
+    Content-addressed LRU store of rendered HTML and PNGs,
+    along with the Telegram file_id of each uploaded image.
+    Entries are evicted when too old, or when over the entry count or byte size limits.
+    """
+
+    def __init__(
+        self, max_entries: int = 512, max_bytes: int = 2**26, max_age: float = 86400
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries: OrderedDict[str, Render] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[Render]:
+        with self.lock:
+            render = self.entries.get(key)
+            if render and monotonic() - render.created > self.max_age:
+                self._evict(key)
+                render = None
+            if render:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return render
+
+    def put(self, key: str, render: Render):
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            self.entries[key] = render
+            self.bytes += render.size
+            while self.entries and (
+                len(self.entries) > self.max_entries or self.bytes > self.max_bytes
+            ):
+                self._evict(next(iter(self.entries)))
+
+    def remember_upload(self, key: str, message: Message):
+        """Store the file_id of an uploaded image, for resending by reference"""
+        with self.lock:
+            render = self.entries.get(key)
+            if render:
+                render.file_kind, render.file_id = message_file_id(message)
+
+    def forget_upload(self, key: str):
+        with self.lock:
+            render = self.entries.get(key)
+            if render:
+                render.file_kind, render.file_id = None, None
+
+    def _evict(self, key: str):
+        self.bytes -= self.entries.pop(key).size
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe mapping of limited size, dropping the least recently used keys"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+ABSENT = object()
+
+
+class CachedKeyValue:
+    """
+    Write-through LRU cache in front of a KeyValue table,
+    which also remembers which keys are absent.
+    With a ttl, entries are reread once that old,
+    to pick up changes written by other processes.
+    """
+
+    def __init__(
+        self, store: KeyValue, max_entries: int = 4096, ttl: Optional[float] = None
+    ):
+        self.store = store
+        self.ttl = ttl
+        self.cache = LRUCache(max_entries)
+        self.lock = Lock()
+
+    def _lookup(self, key):
+        value, stamp = self.cache.get(key, (MISSING, None))
+        if value is MISSING or (self.ttl is not None and monotonic() - stamp > self.ttl):
+            with self.lock, METRICS.timer('ccb_stage_seconds', stage='db_read'):
+                value = self.store.get(key, ABSENT)
+                self.cache[key] = (value, monotonic())
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is ABSENT else value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is ABSENT:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock, METRICS.timer('ccb_stage_seconds', stage='db_write'):
+            self.store[key] = value
+            self.cache[key] = (value, monotonic())
+
+    def __delitem__(self, key):
+        with self.lock, METRICS.timer('ccb_stage_seconds', stage='db_write'):
+            del self.store[key]
+            self.cache[key] = (ABSENT, monotonic())
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+
+class AdminCache:
+    """
+    Remember each group's administrators (including its creator),
+    fetched all at once with get_chat_administrators,
+    and refreshed once stale or adjusted by chat_member updates.
+    """
+
+    def __init__(self, bot: TeleBot, max_chats: int = 1024, ttl: float = 600):
+        self.bot = bot
+        self.ttl = ttl
+        self.chats = LRUCache(max_chats)
+        self.fetches = 0
+
+    def is_admin(self, chat_id: int, user_id: int) -> bool:
+        fetched, admins = self.chats.get(chat_id, (None, None))
+        if admins is None or monotonic() - fetched > self.ttl:
+            admins = {
+                member.user.id for member in self.bot.get_chat_administrators(chat_id)
+            }
+            self.chats[chat_id] = (monotonic(), admins)
+            self.fetches += 1
+        return user_id in admins
+
+    def update(self, member_update: ChatMemberUpdated):
+        fetched, admins = self.chats.get(member_update.chat.id, (None, None))
+        if admins is None:
+            return
+        user_id = member_update.new_chat_member.user.id
+        if member_update.new_chat_member.status in ('administrator', 'creator'):
+            admins = admins | {user_id}
+        else:
+            admins = admins - {user_id}
+        self.chats[member_update.chat.id] = (fetched, admins)
+
+    def stats(self) -> dict:
+        return {**self.chats.stats(), 'fetches': self.fetches}
+
 
-    return str(png)
+def snippet_hash(code: str) -> str:
+    """Return a hash of the code, ignoring line ending style and outer whitespace"""
+    return sha256('\n'.join(code.strip().splitlines()).encode()).hexdigest()
 
 
-def minikb(kb_name: str, mini_text: str = '. . .') -> InlineKeyboardMarkup:
+SYNTAX_ALIASES = {
+    # fmt: off
+    'bash': 'sh',   'zsh': 'sh',      'shell': 'sh',   'console': 'sh',
+    'python': 'py3', 'python3': 'py3', 'py': 'py3',
+    'javascript': 'js', 'node': 'js', 'typescript': 'ts', 'deno': 'ts',
+    'ruby': 'rb',   'rust': 'rust',   'yml': 'yaml',   'golang': 'go',
+    'c++': 'c',     'cpp': 'c',       'powershell': 'ps1', 'pwsh': 'ps1',
+    'rscript': 'r', 'latex': 'tex',   'haskell': 'hs', 'patch': 'diff',
+    # fmt: on
+}
+
+HINT_PATTERNS = (
+    # shebang:
+    re.compile(r'\A#!\s*\S*?(?:/env(?:\s+-\S+)*\s+|/)([\w+.-]+?)[\d.]*(?:\s|\Z)'),
+    # fenced block:
+    re.compile(r'\A(?:```|~~~)\s*([\w+#-]+)'),
+    # vim modeline:
+    re.compile(r'\b(?:vim?|ex):.*?\b(?:ft|filetype|syn|syntax)=([\w+#-]+)', re.M),
+    # emacs modeline:
+    re.compile(r'-\*-\s*(?:.*?mode:\s*)?([\w+#-]+?)\s*(?:;.*?)?-\*-', re.M),
+)
+
+CONFIDENT_PREFIXES = {
+    # fmt: off
+    '<?php': 'php', '<?xml': 'xml', '<!doctype html': 'html', '<html': 'html',
+    'diff --git ': 'diff', '\\documentclass': 'tex',
+    # fmt: on
+}
+
+
+def preclassify_ext(code: str, syntax_names: Mapping[str, str]) -> Optional[str]:
+    """
+    Return the syntax named by a shebang, fenced block, or modeline,
+    or implied by an unambiguous prefix.
+    syntax_names maps lowercase names and extensions to extensions.
+    """
+    edges = '\n'.join((*code.lstrip().splitlines()[:5], *code.splitlines()[-5:]))
+    for pattern in HINT_PATTERNS:
+        match = pattern.search(edges)
+        if match and match[1].lower() in syntax_names:
+            return syntax_names[match[1].lower()]
+    start = code.lstrip()[:16].lower()
+    for prefix, ext in CONFIDENT_PREFIXES.items():
+        if start.startswith(prefix):
+            return ext
+
+
+def load_guesser() -> 'Guess':
+    # guesslang imports tensorflow, which takes seconds, so it's only imported here
+    from guesslang import Guess
+
+    return Guess()
+
+
+def batch_probabilities(
+    guesser: 'Guess', codes: List[str]
+) -> List[List[tuple[str, float]]]:
+    """Like Guess.probabilities, but for many snippets in a single model call"""
+    import tensorflow as tf
+
+    predicted = guesser._model.signatures['serving_default'](tf.constant(codes))
+    return [
+        sorted(
+            (
+                (guesser._extension_map[ext.decode()], float(score))
+                for ext, score in zip(classes, scores)
+            ),
+            key=itemgetter(1),
+            reverse=True,
+        )
+        for scores, classes in zip(
+            predicted['scores'].numpy(), predicted['classes'].numpy()
+        )
+    ]
+
+
+class GuessService:
+    """
+    Collect snippets submitted within a short window into one batched model call,
+    made from a dedicated thread, and return futures of their probabilities.
+
+    The model is loaded by that same thread, in the background;
+    the ready future resolves to the loaded guesser, or the loading error.
+    """
+
+    def __init__(
+        self,
+        load_guesser: Callable[[], 'Guess'] = load_guesser,
+        batch_size: int = 16,
+        max_wait: float = 0.05,
+        log: Optional[BindableLogger] = None,
+    ):
+        self.load_guesser = load_guesser
+        self.log = log
+        self.ready = Future()
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = Queue()
+        self.worker = Thread(target=self._work, name='guesslang', daemon=True)
+        self.worker.start()
+
+    def submit(self, code: str) -> Future:
+        future = Future()
+        self.requests.put((code, future))
+        return future
+
+    def _load(self):
+        self.ready.set_running_or_notify_cancel()
+        started = monotonic()
+        try:
+            guesser = self.load_guesser()
+        except Exception as e:
+            self.ready.set_exception(e)
+            if self.log:
+                self.log.error("failed to load guesslang model", exc_info=e)
+            raise
+        self.ready.set_result(guesser)
+        if self.log:
+            self.log.msg("loaded guesslang model", seconds=monotonic() - started)
+
+    def _work(self):
+        self._load()
+        guesser = self.ready.result()
+        while True:
+            batch = [self.requests.get()]
+            deadline = monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        self.requests.get(timeout=max(0, deadline - monotonic()))
+                    )
+                except Empty:
+                    break
+            batch = [(code, f) for code, f in batch if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = batch_probabilities(guesser, [code for code, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), probabilities in zip(batch, results):
+                    future.set_result(probabilities)
+            METRICS.count('ccb_guess_batches_total')
+            METRICS.count('ccb_guess_batch_snippets_total', len(batch))
+
+
+@functools.cache
+def minikb(kb_name: str, mini_text: str = '. . .') -> FrozenMarkup:
     """
     Return an inline KB with just one button,
     which restores the specified KB by name when pressed.
@@ -202,22 +1511,52 @@ def minikb(kb_name: str, mini_text: str = '. . .') -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
     kb.add(
         InlineKeyboardButton(
-            mini_text, callback_data=ydump({'action': 'restore', 'kb_name': kb_name})
+            mini_text, callback_data=cbdump({'action': 'restore', 'kb_name': kb_name})
         ),
         BEGONE_BUTTON,
     )
-    return kb
+    return FrozenMarkup(kb)
+
+
+def retry_delay(
+    error: Exception,
+    attempt: int,
+    exceptions: Union[Exception, tuple[Exception]] = ConnectionError,
+    seconds: float = 3,
+    max_seconds: float = 60,
+    flood_control: bool = False,
+) -> Optional[float]:
+    """
+    Return how long to wait before retrying after the error, or None to give up.
+    With flood_control, a 429 that outlasted Transport's own waits says how long;
+    otherwise back off exponentially, with full jitter.
+    """
+    if (
+        flood_control
+        and isinstance(error, ApiTelegramException)
+        and error.error_code == 429
+    ):
+        with suppress(KeyError, TypeError):
+            return float(error.result_json['parameters']['retry_after'])
+    elif not isinstance(error, exceptions):
+        return None
+    return random.uniform(0, min(max_seconds, seconds * 2**attempt))
 
 
 def retry(
     original: Callable = None,  # needed to make args altogether optional
-    exceptions: Union[Exception, Iterable[Exception]] = ConnectionError,
+    exceptions: Union[Exception, tuple[Exception]] = ConnectionError,
     attempts: int = 6,
     seconds: float = 3,
+    max_seconds: float = 60,
 ) -> Union[WraptFunc, functools.partial[WraptFunc]]:
     if not original:  # needed to make args altogether optional
         return functools.partial(
-            retry, exceptions=exceptions, attempts=attempts, seconds=seconds
+            retry,
+            exceptions=exceptions,
+            attempts=attempts,
+            seconds=seconds,
+            max_seconds=max_seconds,
         )
 
     @decorator
@@ -229,23 +1568,435 @@ def retry(
         for attempt in range(attempts):
             try:
                 resp = original(*args, **kwargs)
-            except exceptions as e:
+            except Exception as e:
+                delay = retry_delay(e, attempt, exceptions, seconds, max_seconds)
+                if delay is None:
+                    raise
+                METRICS.count(
+                    'ccb_retries_total',
+                    function=original.__name__,
+                    cause=type(e).__name__,
+                )
                 last_error = e
                 if has_logger:
                     log = log.bind(exc_info=e)
                     # exc_info will get overwritten by most recent attempt
-                sleep(seconds)
+                sleep(delay)
             else:
                 last_error = None
                 break
             if has_logger and attempt > 0:
                 log.msg("called retry-able", retries=attempt, success=not last_error)
         if last_error:
+            METRICS.count('ccb_retries_exhausted_total', function=original.__name__)
             raise last_error
         return resp
 
-    # return wrapper
-    return wrapper(original)  # needed to make args altogether optional
+    # return wrapper
+    return wrapper(original)  # needed to make args altogether optional
+
+
+class TokenBucket:
+    """Allow a steady rate of events per second, with bursts up to a limit"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = monotonic()
+        self.lock = Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning how many seconds to wait before using it"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return max(0, -self.tokens / self.rate)
+
+    def take(self) -> bool:
+        """Take a token if one is available now, returning whether it was"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+RATE_LIMITED_METHOD_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+
+class RateLimiter:
+    """
+    Pace outbound messages to stay under Telegram's limits,
+    with one token bucket for the whole bot and one per chat (groups are stricter),
+    and drop chat actions that would only repeat one still on display.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        global_burst: int = 30,
+        private_rate: float = 1,
+        private_burst: int = 3,
+        group_rate: float = 20 / 60,
+        group_burst: int = 5,
+        max_chats: int = 4096,
+        action_seconds: float = 5,
+    ):
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.chat_buckets = LRUCache(max_chats)
+        self.chat_actions = LRUCache(max_chats)
+        self.action_seconds = action_seconds
+        self.waits = deque(maxlen=256)
+        self.dropped_actions = 0
+        self.lock = Lock()
+
+    def chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if not bucket:
+                is_group = not str(chat_id).lstrip('-').isdigit() or int(chat_id) < 0
+                bucket = self.chat_buckets[chat_id] = (
+                    TokenBucket(self.group_rate, self.group_burst)
+                    if is_group
+                    else TokenBucket(self.private_rate, self.private_burst)
+                )
+            return bucket
+
+    def acquire(self, chat_id: Union[int, str, None] = None):
+        """Block until a message may be sent (to the chat, if given)"""
+        delay = self.bucket.reserve()
+        if chat_id is not None:
+            chat_id = str(chat_id)
+            delay = max(delay, self.chat_bucket(chat_id).reserve())
+            # A new message ends any chat action on display:
+            self.chat_actions.pop(chat_id)
+        if delay:
+            sleep(delay)
+        with self.lock:
+            self.waits.append(delay)
+
+    def send_chat_action(self, bot: TeleBot, chat_id: Union[int, str], action: str):
+        """Send the chat action, unless it's already on display in that chat"""
+        key = str(chat_id)
+        shown = self.chat_actions.get(key)
+        if shown and shown[0] == action and monotonic() - shown[1] < self.action_seconds:
+            with self.lock:
+                self.dropped_actions += 1
+            return
+        self.chat_actions[key] = (action, monotonic())
+        bot.send_chat_action(chat_id, action)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'chats': len(self.chat_buckets.entries),
+                'dropped_actions': self.dropped_actions,
+                'wait_p50': percentile(self.waits, 50),
+                'wait_p95': percentile(self.waits, 95),
+                'wait_max': max(self.waits, default=None),
+            }
+
+
+ADMISSION_PRIORITIES = {'private': 0, 'explicit': 1, 'group watch': 2, 'stale': 3}
+
+
+def admission_priority(chat: Chat, explicit: bool = False) -> str:
+    if chat.type == 'private':
+        return 'private'
+    return 'explicit' if explicit else 'group watch'
+
+
+class AdmissionQueue:
+    """
+    Run code handling jobs on a fixed set of worker threads, in priority order:
+    private chats, then explicit requests in groups, then group watch mode,
+    then anything that was already older than max_age when it arrived.
+
+    Rather than queue work nobody is waiting for, group watch mode updates
+    older than max_age are dropped, whether on arrival or once reached in the queue.
+    Jobs in each group are limited by a budget (a token bucket),
+    and new group watch mode jobs are shed while the oldest runnable job
+    has waited longer than shed_latency.
+
+    Each chat's jobs run one at a time, in the order they were submitted:
+    only the oldest of a chat's jobs is in the priority queue,
+    and the next is added once it's done.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_age: float = 120,
+        shed_latency: float = 10,
+        group_rate: float = 10 / 60,
+        group_burst: int = 5,
+        max_groups: int = 4096,
+        log: Optional[BindableLogger] = None,
+    ):
+        self.max_age = max_age
+        self.shed_latency = shed_latency
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.group_budgets = LRUCache(max_groups)
+        self.log = log
+        self.heap = []
+        self.order = count()
+        self.busy_chats = set()
+        self.chat_backlogs: dict[int, deque] = {}
+        self.cond = Condition()
+        self.workers = [
+            Thread(target=self._work, name=f'admission-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        METRICS.gauge('ccb_admission_queue_depth', self.depth)
+
+    def depth(self) -> int:
+        with self.cond:
+            return len(self.heap) + sum(map(len, self.chat_backlogs.values()))
+
+    def latency(self) -> float:
+        """
+        Return how long the oldest runnable job has waited for a worker,
+        not counting any wait behind its own chat's earlier jobs
+        """
+        now = monotonic()
+        with self.cond:
+            return max((now - entry[2] for entry in self.heap), default=0)
+
+    def group_budget(self, chat_id: int) -> TokenBucket:
+        with self.cond:
+            budget = self.group_budgets.get(chat_id)
+            if not budget:
+                budget = self.group_budgets[chat_id] = TokenBucket(
+                    self.group_rate, self.group_burst
+                )
+            return budget
+
+    def submit(
+        self, priority: str, chat_id: int, sent: Optional[float], job: Callable[[], Any]
+    ) -> Optional[Future]:
+        """
+        Queue the job, unless it's shed, and return a future of its result.
+        sent is the Unix time the update was sent, if known, to judge its age.
+        """
+        reason = None
+        if sent and time() - sent > self.max_age:
+            if priority == 'group watch':
+                reason = 'stale'
+            else:
+                priority = 'stale'
+        elif priority == 'group watch' and self.latency() > self.shed_latency:
+            reason = 'overloaded'
+        if not reason and chat_id < 0 and not self.group_budget(chat_id).take():
+            reason = 'over budget'
+        if reason:
+            self.shed(reason, priority, chat_id, sent)
+            return None
+        METRICS.count(
+            'ccb_admissions_total',
+            priority=priority,
+            outcome='downgraded' if priority == 'stale' else 'queued',
+        )
+        future = Future()
+        queued = monotonic()
+        entry = (
+            ADMISSION_PRIORITIES[priority],
+            next(self.order),
+            queued,  # when it became runnable
+            queued,
+            priority,
+            chat_id,
+            sent,
+            job,
+            future,
+        )
+        with self.cond:
+            if chat_id in self.busy_chats:
+                self.chat_backlogs.setdefault(chat_id, deque()).append(entry)
+            else:
+                self.busy_chats.add(chat_id)
+                heappush(self.heap, entry)
+                self.cond.notify()
+        return future
+
+    def shed(self, reason: str, priority: str, chat_id: int, sent: Optional[float]):
+        METRICS.count('ccb_admissions_total', priority=priority, outcome=reason)
+        if self.log:
+            self.log.msg(
+                "shed update",
+                reason=reason,
+                priority=priority,
+                chat_id=chat_id,
+                age=time() - sent if sent else None,
+                queue_depth=self.depth(),
+            )
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                _, _, _, queued, priority, chat_id, sent, job, future = heappop(
+                    self.heap
+                )
+            try:
+                self._run(queued, priority, chat_id, sent, job, future)
+            finally:
+                self._next_in_chat(chat_id)
+
+    def _run(
+        self,
+        queued: float,
+        priority: str,
+        chat_id: int,
+        sent: Optional[float],
+        job: Callable[[], Any],
+        future: Future,
+    ):
+        METRICS.observe(
+            'ccb_admission_wait_seconds', monotonic() - queued, priority=priority
+        )
+        if priority == 'group watch' and sent and time() - sent > self.max_age:
+            future.cancel()
+            self.shed('expired', priority, chat_id, sent)
+            return
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(job())
+        except Exception as e:
+            future.set_exception(e)
+            if self.log:
+                self.log.error(
+                    "admitted job failed",
+                    exc_info=e,
+                    priority=priority,
+                    chat_id=chat_id,
+                )
+
+    def _next_in_chat(self, chat_id: int):
+        """Queue the chat's next job, now that its last one is done"""
+        with self.cond:
+            backlog = self.chat_backlogs.get(chat_id)
+            if not backlog:
+                self.busy_chats.discard(chat_id)
+                return
+            rank, order, _, *rest = backlog.popleft()
+            heappush(self.heap, (rank, order, monotonic(), *rest))
+            if not backlog:
+                del self.chat_backlogs[chat_id]
+            self.cond.notify()
+
+
+DEFAULT_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+
+class Transport:
+    """
+    Send all Bot API requests through one shared session with a sized connection pool,
+    as pyTelegramBotAPI's request sender, optionally to a local Bot API server.
+    Uploads get their own, longer, read timeout.
+    Outbound messages wait on the rate limiter, if given.
+    Flood control (429) is waited out here, per request, so that retrying never
+    repeats any other step of a handler.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 16,
+        keep_alive: bool = True,
+        connect_timeout: float = 5,
+        read_timeout: float = 30,
+        upload_timeout: float = 120,
+        api_url: Optional[str] = None,
+        limiter: Optional[RateLimiter] = None,
+        flood_waits: int = 3,
+        max_flood_wait: float = 60,
+    ):
+        self.limiter = limiter
+        self.flood_waits = flood_waits
+        self.max_flood_wait = max_flood_wait
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.upload_timeout = upload_timeout
+        self.api_url = api_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+        apihelper.CONNECT_TIMEOUT = self.connect_timeout
+        apihelper.READ_TIMEOUT = self.read_timeout
+        if self.api_url:
+            apihelper.API_URL = f"{self.api_url}/bot{{0}}/{{1}}"
+            apihelper.FILE_URL = f"{self.api_url}/file/bot{{0}}/{{1}}"
+
+    def send(
+        self, method: str, url: str, params=None, files=None, timeout=None, proxies=None
+    ) -> requests.Response:
+        connect_timeout, read_timeout = timeout or (
+            self.connect_timeout,
+            self.read_timeout,
+        )
+        if files:
+            read_timeout = max(read_timeout, self.upload_timeout)
+        api_method = url.rsplit('/', 1)[-1]
+        if (
+            self.limiter
+            and api_method.startswith(RATE_LIMITED_METHOD_PREFIXES)
+            and api_method != 'sendChatAction'
+        ):
+            with METRICS.timer('ccb_rate_limit_wait_seconds'):
+                self.limiter.acquire((params or {}).get('chat_id'))
+        for wait in range(self.flood_waits + 1):
+            with METRICS.timer('ccb_api_seconds', method=api_method):
+                resp = self.session.request(
+                    method,
+                    url,
+                    params=params,
+                    files=files,
+                    timeout=(connect_timeout, read_timeout),
+                    proxies=proxies,
+                )
+            if resp.status_code != 429 or wait == self.flood_waits:
+                return resp
+            delay = flood_wait(resp)
+            if delay is None or delay > self.max_flood_wait:
+                return resp
+            METRICS.count(
+                'ccb_retries_total', function=api_method, cause='flood control'
+            )
+            sleep(delay)
+            for upload in (files or {}).values():
+                # Rewind any file objects already read by the first request:
+                upload = upload[1] if isinstance(upload, tuple) else upload
+                if hasattr(upload, 'seek'):
+                    upload.seek(0)
+        return resp
+
+
+def flood_wait(resp: requests.Response) -> Optional[float]:
+    """Return the seconds a flood controlled (429) response says to wait, if any"""
+    with suppress(ValueError, KeyError, TypeError):
+        return float(resp.json()['parameters']['retry_after'])
 
 
 def mk_logger(json=True) -> BindableLogger:
@@ -260,9 +2011,19 @@ def mk_logger(json=True) -> BindableLogger:
     return structlog.get_logger()
 
 
+def send_chat_action(bot, chat_id, action: str, limiter: Optional[RateLimiter] = None):
+    if limiter:
+        limiter.send_chat_action(bot, chat_id, action)
+    else:
+        bot.send_chat_action(chat_id, action)
+
+
+@METRICS.timed('ccb_stage_seconds', stage='send_html')
 @retry
-def send_html(bot, chat_id, html: str, reply_msg_id=None) -> Message:
-    bot.send_chat_action(chat_id, 'upload_document')
+def send_html(
+    bot, chat_id, html: str, reply_msg_id=None, limiter: Optional[RateLimiter] = None
+) -> Message:
+    send_chat_action(bot, chat_id, 'upload_document', limiter)
     with io.StringIO(html) as doc:
         doc.name = 'code.html'
         return bot.send_document(
@@ -270,31 +2031,133 @@ def send_html(bot, chat_id, html: str, reply_msg_id=None) -> Message:
         )
 
 
-@retry
-def delete_after_delay(bot, message, delay=60, log: Optional[BindableLogger] = None):
-    sleep(delay)
-    try:
-        bot.delete_message(message.chat.id, message.message_id)
-    except ApiException as e:
-        if log:
-            log.error(
-                "failed to delete message (it's probably gone already)",
-                exc_info=e,
-                chat_id=message.chat.id,
+class DeletionScheduler:
+    """
+    Delete messages once they're due, all from a single worker thread.
+    Pending deletions are stored in a KeyValue table ({'chat_id:message_id': due}),
+    so they survive restarts.
+    If owns is given, only pending deletions in chats it accepts are loaded,
+    leaving the rest to other processes sharing the table.
+    """
+
+    def __init__(
+        self,
+        bot: TeleBot,
+        pending: KeyValue,
+        attempts: int = 3,
+        retry_seconds: float = 5,
+        log: Optional[BindableLogger] = None,
+        owns: Optional[Callable[[int], bool]] = None,
+    ):
+        self.bot = bot
+        self.pending = pending
+        self.attempts = attempts
+        self.retry_seconds = retry_seconds
+        self.log = log
+        self.heap = []
+        self.cond = Condition()
+        # A fresh DB's table creation may still be queued, but then nothing's pending:
+        with suppress(OperationalError):
+            for key, due in self.pending.items():
+                chat_id, message_id = map(int, key.split(':'))
+                if not owns or owns(chat_id):
+                    heappush(self.heap, (due, chat_id, message_id, 0))
+        self.worker = Thread(target=self._work, name='deletions', daemon=True)
+        self.worker.start()
+        METRICS.gauge('ccb_deletion_backlog', self.backlog)
+
+    def schedule(self, message: Message, delay: float):
+        due = time() + delay
+        self.pending[f"{message.chat.id}:{message.message_id}"] = due
+        with self.cond:
+            heappush(self.heap, (due, message.chat.id, message.message_id, 0))
+            self.cond.notify()
+
+    def backlog(self) -> int:
+        with self.cond:
+            return len(self.heap)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time():
+                    self.cond.wait(self.heap[0][0] - time() if self.heap else None)
+                batch = []
+                while self.heap and self.heap[0][0] <= time():
+                    batch.append(heappop(self.heap))
+            for due, chat_id, message_id, attempt in batch:
+                METRICS.observe('ccb_deletion_lag_seconds', time() - due)
+                try:
+                    self._delete(chat_id, message_id, attempt)
+                except Exception as e:  # keep the only worker alive
+                    METRICS.count('ccb_deletions_total', outcome='error')
+                    if self.log:
+                        self.log.error(
+                            "unexpected error deleting message",
+                            exc_info=e,
+                            chat_id=chat_id,
+                        )
+
+    def _delete(self, chat_id: int, message_id: int, attempt: int):
+        try:
+            self.bot.delete_message(chat_id, message_id)
+        except Exception as e:
+            # Flood control says when to retry, and network errors back off:
+            delay = retry_delay(
+                e,
+                attempt,
+                requests.RequestException,
+                self.retry_seconds,
+                flood_control=True,
             )
+            if delay is not None and attempt + 1 < self.attempts:
+                with self.cond:
+                    heappush(
+                        self.heap, (time() + delay, chat_id, message_id, attempt + 1)
+                    )
+                    self.cond.notify()
+                METRICS.count('ccb_deletions_total', outcome='retrying')
+                return
+            if delay is None and isinstance(e, ApiException):
+                METRICS.count('ccb_deletions_total', outcome='failed')
+                if self.log:
+                    self.log.error(
+                        "failed to delete message (it's probably gone already)",
+                        exc_info=e,
+                        chat_id=chat_id,
+                    )
+            else:
+                METRICS.count('ccb_deletions_total', outcome='gave up')
+                if self.log:
+                    self.log.error(
+                        "gave up deleting message", exc_info=e, chat_id=chat_id
+                    )
+        else:
+            METRICS.count('ccb_deletions_total', outcome='deleted')
+        del self.pending[f"{chat_id}:{message_id}"]
 
 
+@METRICS.timed('ccb_stage_seconds', stage='send_image')
 @retry
 def send_image(
-    bot, chat_id, png_path: str, reply_msg_id=None, log: Optional[BindableLogger] = None
+    bot,
+    chat_id,
+    png: bytes,
+    reply_msg_id=None,
+    reply_markup=None,
+    log: Optional[BindableLogger] = None,
+    limiter: Optional[RateLimiter] = None,
 ) -> Message:
-    bot.send_chat_action(chat_id, 'upload_photo')
+    send_chat_action(bot, chat_id, 'upload_photo', limiter)
 
-    if local.path(png_path).stat().st_size < 300000:
+    if fits_photo(png):
         try:
-            with open(png_path, 'rb') as doc:
-                return bot.send_photo(chat_id, doc, reply_to_message_id=reply_msg_id)
+            return bot.send_photo(
+                chat_id, png, reply_to_message_id=reply_msg_id, reply_markup=reply_markup
+            )
         except ApiException as e:
+            if isinstance(e, ApiTelegramException) and e.error_code == 429:
+                raise  # flood control outlasted Transport: a document would be no better
             if log:
                 log.error(
                     "failed to send compressed image",
@@ -302,8 +2165,45 @@ def send_image(
                     chat_id=chat_id,
                 )
 
-    with open(png_path, 'rb') as doc:
-        return bot.send_document(chat_id, doc, reply_to_message_id=reply_msg_id)
+    with io.BytesIO(png) as doc:
+        doc.name = 'code.png'
+        return bot.send_document(
+            chat_id, doc, reply_to_message_id=reply_msg_id, reply_markup=reply_markup
+        )
+
+
+@METRICS.timed('ccb_stage_seconds', stage='resend_image')
+@retry
+def resend_image(
+    bot, chat_id, file_id: str, file_kind: str, reply_msg_id=None, reply_markup=None
+) -> Message:
+    """Send an already uploaded image (or other file) by reference"""
+    send = bot.send_photo if file_kind == 'photo' else bot.send_document
+    return send(
+        chat_id, file_id, reply_to_message_id=reply_msg_id, reply_markup=reply_markup
+    )
+
+
+def message_file_id(message: Message) -> tuple[str, str]:
+    """Return the kind (photo or document) and file_id of a message's attachment"""
+    if message.content_type == 'photo':
+        return 'photo', message.photo[-1].file_id
+    return 'document', message.document.file_id
+
+
+FILE_REFERENCE_ERRORS = (
+    'wrong file identifier',
+    'file reference expired',
+    'wrong remote file',
+)
+
+
+def is_file_reference_error(error: Exception) -> bool:
+    """Whether Telegram rejected a file_id itself, rather than the rest of a request"""
+    if not isinstance(error, ApiTelegramException) or error.error_code != 400:
+        return False
+    description = (error.description or '').lower().replace('_', ' ')
+    return any(reason in description for reason in FILE_REFERENCE_ERRORS)
 
 
 def code_subcontent(message: Message) -> Optional[str]:
@@ -323,69 +2223,225 @@ class ColorCodeBot:
         api_key: str,
         lang: Mapping[str, str],
         theme_image_ids: tuple[str],
-        keyboards: Mapping[str, InlineKeyboardMarkup],
+        keyboards: Mapping[str, FrozenMarkup],
         guesslang_syntaxes: Mapping[str, str],
         *args: Any,
         admin_chat_id: Optional[str] = None,
+        tuning: Optional[Mapping[str, Mapping[str, Union[int, float]]]] = None,
         db_path: str = str(local.path(__file__).up() / 'db-files' / 'ccb.sqlite'),
+        shard: Optional[tuple[int, int]] = None,
         **kwargs: Any,
     ):
+        started = monotonic()
+        self.shard = shard
         self.lang = lang
         self.theme_image_ids = theme_image_ids
         self.kb = keyboards
+        self.query_guessed_ext_md = f"{lang['query ext']}\n\n{lang['guessed syntax']}"
         self.guesslang_syntaxes = guesslang_syntaxes
         self.admin_chat_id = admin_chat_id
+        self.tuning = tuning or load_configs()['tuning']
         self.log = mk_logger()
+        self.render_cache = RenderCache(
+            max_entries=self.tuning['render cache']['max entries'],
+            max_bytes=self.tuning['render cache']['max bytes'],
+            max_age=self.tuning['render cache']['max age seconds'],
+        )
+        self.render_pool = RenderPool(
+            workers=self.tuning['render pool']['workers'],
+            queue_size=self.tuning['render pool']['queue size'],
+            timeout=self.tuning['render pool']['timeout seconds'],
+        )
+        self.png_optimizer = PngOptimizer(
+            quantize_quality=self.tuning['png optimizer'].get('quantize quality'),
+            recompress_level=self.tuning['png optimizer'].get('recompress level'),
+            timeout=self.tuning['png optimizer']['timeout seconds'],
+        )
+        self.page_limits = {
+            'max_lines': self.tuning['paging']['max lines per page'],
+            'max_bytes': self.tuning['paging']['max bytes per page'],
+            # An album holds up to 10 photos or documents
+            'max_pages': min(10, self.tuning['paging']['max pages']),
+        }
+        self.admission = AdmissionQueue(
+            workers=self.tuning['admission']['workers'],
+            max_age=self.tuning['admission']['max age seconds'],
+            shed_latency=self.tuning['admission']['shed latency seconds'],
+            group_rate=self.tuning['admission']['group jobs per minute'] / 60,
+            group_burst=self.tuning['admission']['group burst'],
+            max_groups=self.tuning['admission']['max groups'],
+            log=self.log,
+        )
+        self.pipeline = ThreadPoolExecutor(
+            max_workers=self.tuning['pipeline']['workers'], thread_name_prefix='pipeline'
+        )
         self.db_path = db_path
         self.db = SqliteDatabase(self.db_path)
-        self.user_themes = KeyValue(
-            key_field=IntegerField(primary_key=True),
-            value_field=CharField(),
-            database=self.db,
-            table_name='user_theme',
+        # Only sharded workers write settings behind each other's caches:
+        settings_ttl = (
+            self.tuning['settings cache'].get('sharded ttl seconds') if shard else None
         )
-        self.group_syntaxes = KeyValue(
-            key_field=IntegerField(primary_key=True),
-            value_field=CharField(),
-            database=self.db,
-            table_name='group_syntax',
+        self.user_themes = CachedKeyValue(
+            KeyValue(
+                key_field=IntegerField(primary_key=True),
+                value_field=CharField(),
+                database=self.db,
+                table_name='user_theme',
+            ),
+            max_entries=self.tuning['settings cache']['max entries'],
+            ttl=settings_ttl,
         )
-        self.ignore_mode_groups = KeyValue(
-            key_field=IntegerField(primary_key=True),
-            value_field=BooleanField(),
-            database=self.db,
-            table_name='group_in_ignore_mode',
+        self.group_syntaxes = CachedKeyValue(
+            KeyValue(
+                key_field=IntegerField(primary_key=True),
+                value_field=CharField(),
+                database=self.db,
+                table_name='group_syntax',
+            ),
+            max_entries=self.tuning['settings cache']['max entries'],
+            ttl=settings_ttl,
+        )
+        self.ignore_mode_groups = CachedKeyValue(
+            KeyValue(
+                key_field=IntegerField(primary_key=True),
+                value_field=BooleanField(),
+                database=self.db,
+                table_name='group_in_ignore_mode',
+            ),
+            max_entries=self.tuning['settings cache']['max entries'],
+            ttl=settings_ttl,
+        )
+        self.group_user_current_watchme_requests = CachedKeyValue(
+            KeyValue(
+                key_field=CharField(primary_key=True),
+                value_field=CharField(),
+                database=self.db,
+                table_name='group_user_current_watchme_request',
+            ),
+            max_entries=self.tuning['settings cache']['max entries'],
+            ttl=settings_ttl,
         )
-        self.group_user_current_watchme_requests = KeyValue(
+        self.file_ids = CachedKeyValue(
+            KeyValue(
+                key_field=CharField(primary_key=True),
+                value_field=CharField(),
+                database=self.db,
+                table_name='render_file_id',
+            ),
+            max_entries=self.tuning['file id cache']['max entries'],
+        )
+        self.pending_deletions = KeyValue(
             key_field=CharField(primary_key=True),
-            value_field=CharField(),
+            value_field=FloatField(),
             database=self.db,
-            table_name='group_user_current_watchme_request',
+            table_name='pending_deletion',
+        )
+        self.limiter = RateLimiter(
+            global_rate=self.tuning['rate limits']['global per second'],
+            global_burst=self.tuning['rate limits']['global burst'],
+            private_rate=self.tuning['rate limits']['private chat per second'],
+            private_burst=self.tuning['rate limits']['private chat burst'],
+            group_rate=self.tuning['rate limits']['group chat per minute'] / 60,
+            group_burst=self.tuning['rate limits']['group chat burst'],
+            max_chats=self.tuning['rate limits']['max chats'],
+            action_seconds=self.tuning['rate limits']['chat action seconds'],
+        )
+        self.transport = Transport(
+            pool_size=self.tuning['transport']['pool size'],
+            keep_alive=self.tuning['transport']['keep alive'],
+            connect_timeout=self.tuning['transport']['connect timeout seconds'],
+            read_timeout=self.tuning['transport']['read timeout seconds'],
+            upload_timeout=self.tuning['transport']['upload timeout seconds'],
+            api_url=self.tuning['transport'].get('api url'),
+            flood_waits=self.tuning['transport']['flood control waits'],
+            max_flood_wait=self.tuning['transport']['max flood wait seconds'],
+            limiter=self.limiter,
         )
+        self.transport.install()
         self.bot = TeleBot(api_key, *args, **kwargs)
+        self.admins = AdminCache(
+            self.bot,
+            max_chats=self.tuning['admin cache']['max chats'],
+            ttl=self.tuning['admin cache']['ttl seconds'],
+        )
+        self.deletions = DeletionScheduler(
+            self.bot,
+            self.pending_deletions,
+            attempts=self.tuning['deletions']['attempts'],
+            retry_seconds=self.tuning['deletions']['retry seconds'],
+            log=self.log,
+            owns=self.owns_chat,
+        )
         self.register_handlers()
-        self.guesser = Guess()
+        self.syntax_names = {
+            **{ext: ext for ext in self.guesslang_syntaxes.values()},
+            **{name.lower(): ext for name, ext in self.guesslang_syntaxes.items()},
+            **SYNTAX_ALIASES,
+        }
+        self.guess_cache = LRUCache(self.tuning['guess cache']['max entries'])
+        self.profiler = SamplingProfiler(self.tuning['profiler']['interval seconds'])
+        self.guess_service = GuessService(
+            batch_size=self.tuning['guess batching']['batch size'],
+            max_wait=self.tuning['guess batching']['max wait seconds'],
+            log=self.log,
+        )
+        self.log.msg("initialized bot", seconds=monotonic() - started)
+
+    def handler_specs(self) -> List[tuple[str, Mapping[str, Any], Callable]]:
+        """Return the kind, filters, and callable of each update handler, in order"""
+        # fmt: off
+        return [
+            ('message',        {'commands': ['start', 'help']},                                             self.welcome),
+            ('message',        {'commands': ['theme', 'themes']},                                           self.browse_themes),
+            ('message',        {'commands': ['settings']},                                                  self.manage_group_options),
+            ('message',        {'commands': ['ignoreme']},                                                  self.ignore_group_user),
+            ('message',        {'commands': ['watchme']},                                                   self.watch_group_user),
+            ('message',        {'commands': ['stats'], 'func': self.is_from_admin_chat},                    self.show_stats),
+            ('message',        {'commands': ['profile'], 'func': self.is_from_admin_chat},                  self.profile),
+            ('message',        {'func': lambda m: m.content_type == 'text'},                                self.intake_snippet),
+            ('message',        {'content_types': ['document'], 'chat_types': ['private']},                  self.intake_document),
+            ('message',        {'content_types': ['photo']},                                                self.recv_photo),
+            ('callback_query', {'func': lambda q: True},                                                    self.dispatch_callback),
+            ('inline',         {'func': lambda q: q.query.startswith("img ")},                              self.send_photo_elsewhere),
+            ('inline',         {'func': lambda q: True},                                                    self.switch_from_inline),
+            ('chat_member',    {'func': lambda u: True},                                                    self.admins.update),
+        ]
+        # fmt: on
+
+    def owns_chat(self, chat_id: int) -> bool:
+        """Return whether this process handles the chat's updates"""
+        if not self.shard:
+            return True
+        index, shards = self.shard
+        return shard_for(chat_id, shards) == index
 
     def register_handlers(self):
+        for kind, filters, handler in self.handler_specs():
+            getattr(self.bot, f'{kind}_handler')(**filters)(handler)
+
+    def callback_handlers(self) -> Mapping[str, Callable]:
         # fmt: off
-        self.welcome              = self.bot.message_handler(commands=['start', 'help'])(self.welcome)
-        self.browse_themes        = self.bot.message_handler(commands=['theme', 'themes'])(self.browse_themes)
-        self.manage_group_options = self.bot.message_handler(commands=['settings'])(self.manage_group_options)
-        self.ignore_group_user    = self.bot.message_handler(commands=['ignoreme'])(self.ignore_group_user)
-        self.watch_group_user     = self.bot.message_handler(commands=['watchme'])(self.watch_group_user)
-        self.intake_snippet       = self.bot.message_handler(func=lambda m: m.content_type == 'text')(self.intake_snippet)
-        self.recv_photo           = self.bot.message_handler(content_types=['photo'])(self.recv_photo)
-        self.restore_kb           = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'restore')(self.restore_kb)
-        self.set_snippet_filetype = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'set ext')(self.set_snippet_filetype)
-        self.set_group_syntax     = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'set default ext')(self.set_group_syntax)
-        self.browse_group_syntax  = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'browse group syntax')(self.browse_group_syntax)
-        self.toggle_group_watch   = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'toggle watch mode')(self.toggle_group_watch)
-        self.set_theme            = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'set theme')(self.set_theme)
-        self.begone               = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'begone')(self.begone)
-        self.send_photo_elsewhere = self.bot.inline_handler(lambda q: q.query.startswith("img "))(self.send_photo_elsewhere)
-        self.switch_from_inline   = self.bot.inline_handler(lambda q: True)(self.switch_from_inline)
+        return {
+            'restore':             self.restore_kb,
+            'set ext':             self.request_snippet_filetype,
+            'set default ext':     self.set_group_syntax,
+            'browse group syntax': self.browse_group_syntax,
+            'toggle watch mode':   self.toggle_group_watch,
+            'set theme':           self.set_theme,
+            'begone':              self.begone,
+        }
         # fmt: on
 
+    def dispatch_callback(self, cb_query: CallbackQuery):
+        """Decode the callback data once, and pass the query to its action's handler"""
+        try:
+            action = cbload(cb_query.data)['action']
+            handler = self.callback_handlers()[action]
+        except Exception as e:
+            self.log.error("unrecognized callback data", data=cb_query.data, exc_info=e)
+            return
+        handler(cb_query)
+
     @retry
     def switch_from_inline(self, inline_query: InlineQuery):
         self.log.msg(
@@ -437,13 +2493,132 @@ class ColorCodeBot:
                 reply_to_message_id=message.message_id,
             )
             for msg in msgs:
-                Thread(
-                    target=delete_after_delay, args=(self.bot, msg, 30, self.log)
-                ).start()
+                self.deletions.schedule(msg, self.tuning['deletions']['delay seconds'])
         self.bot.reply_to(
             message, self.lang['select theme'], reply_markup=self.kb['theme']
         )
 
+    def settings_cache_stats(self) -> Mapping[str, dict]:
+        return {
+            name: getattr(self, name).stats()
+            for name in (
+                'user_themes',
+                'group_syntaxes',
+                'ignore_mode_groups',
+                'group_user_current_watchme_requests',
+            )
+        }
+
+    def is_from_admin_chat(self, message: Message) -> bool:
+        return bool(self.admin_chat_id) and str(message.chat.id) == self.admin_chat_id
+
+    def perf_stats(self) -> dict:
+        """
+        Return live performance figures: memory, threads, queue depths,
+        cache hit rates, guesslang's mean batch size,
+        and the 95th percentile time (as a bucket bound) of each stage
+        """
+        counters, gauges, histograms = METRICS.collect()
+        rss = rss_bytes()
+        batches = counters.get(('ccb_guess_batches_total', ()))
+        return {
+            'rss_mib': round(rss / 2**20, 1) if rss else None,
+            'threads': active_count(),
+            'queue_depths': {
+                f"{name}{prometheus_labels(labels)}": depth
+                for (name, labels), depth in sorted(gauges.items())
+            },
+            'cache_hit_rates': {
+                name: cache.stats()['hit_rate']
+                for name, cache in (
+                    ('render_cache', self.render_cache),
+                    ('guess_cache', self.guess_cache),
+                    ('file_ids', self.file_ids),
+                    ('admins', self.admins),
+                    *(
+                        (name, getattr(self, name))
+                        for name in self.settings_cache_stats()
+                    ),
+                )
+            },
+            'guess_batch_size_mean': (
+                counters[('ccb_guess_batch_snippets_total', ())] / batches
+                if batches
+                else None
+            ),
+            'p95_seconds': {
+                dict(labels)['stage']: histogram.quantile(95)
+                for (name, labels), histogram in sorted(
+                    histograms.items(), key=itemgetter(0)
+                )
+                if name == 'ccb_stage_seconds'
+            },
+        }
+
+    @retry
+    def show_stats(self, message: Message):
+        stats = json.dumps(self.perf_stats(), indent=2)
+        self.log.msg("reporting stats", chat_id=message.chat.id)
+        if len(stats) < 4000:
+            self.bot.reply_to(
+                message, f"<pre>{escape_html(stats)}</pre>", parse_mode='HTML'
+            )
+        else:
+            with io.StringIO(stats) as doc:
+                doc.name = 'stats.json'
+                self.bot.send_document(
+                    message.chat.id, doc, reply_to_message_id=message.message_id
+                )
+
+    @retry
+    def profile(self, message: Message):
+        """
+        Sample stacks for the given number of seconds (or a default),
+        then send them as a document; or, given 'stop', finish early
+        """
+        arg = message.text.split(maxsplit=1)[1].strip() if ' ' in message.text else ''
+        if arg == 'stop':
+            stopping = self.profiler.stop()
+            self.bot.reply_to(
+                message,
+                self.lang['profiler stopping' if stopping else 'profiler idle'],
+                parse_mode='MarkdownV2',
+            )
+            return
+        seconds = self.tuning['profiler']['default seconds']
+        with suppress(ValueError):
+            seconds = max(1, min(int(arg), self.tuning['profiler']['max seconds']))
+        started = self.profiler.start(
+            seconds, functools.partial(self.send_profile, message)
+        )
+        self.log.msg("profiling", seconds=seconds, started=started)
+        self.bot.reply_to(
+            message,
+            self.lang['profiler started'].format(int(seconds))
+            if started
+            else self.lang['profiler busy'],
+            parse_mode='MarkdownV2',
+        )
+
+    def send_profile(self, message: Message, collapsed: str, samples: int):
+        try:
+            if not collapsed:
+                self.bot.reply_to(message, self.lang['profile empty'])
+                return
+            with io.StringIO(collapsed) as doc:
+                doc.name = f"profile-{int(time())}.collapsed"
+                self.bot.send_document(
+                    message.chat.id,
+                    doc,
+                    reply_to_message_id=message.message_id,
+                    caption=self.lang['profile caption'].format(
+                        samples=samples,
+                        interval=self.profiler.interval,
+                    ),
+                )
+        except (ApiException, ConnectionError) as e:
+            self.log.error("failed to send profile", exc_info=e)
+
     @retry
     def get_group_config_md(self, chat_id):
         return self.lang['current config'].format(
@@ -455,13 +2630,14 @@ class ColorCodeBot:
 
     @retry
     def manage_group_options(self, message: Message):
-        is_admin_or_creator = is_from_group_admin_or_creator(self.bot, message)
+        is_admin_or_creator = is_from_group_admin_or_creator(self.admins, message)
         self.log.msg(
             "user requesting group options for viewing or changing",
             user_id=message.from_user.id,
             user_first_name=message.from_user.first_name,
             chat_id=message.chat.id,
             user_is_admin=is_admin_or_creator,
+            admin_cache=self.admins.stats(),
         )
         if is_admin_or_creator:
             self.bot.send_message(
@@ -480,7 +2656,7 @@ class ColorCodeBot:
         )
 
     def toggle_group_watch(self, cb_query: CallbackQuery):
-        is_admin_or_creator = is_from_group_admin_or_creator(self.bot, cb_query)
+        is_admin_or_creator = is_from_group_admin_or_creator(self.admins, cb_query)
         self.log.msg(
             "user trying to toggle group watch mode",
             user_id=cb_query.from_user.id,
@@ -523,9 +2699,22 @@ class ColorCodeBot:
             f"{message.chat.id}:{message.from_user.id}"
         ] = 'watch'
 
+    @retry
+    def answer_callback(self, cb_query: CallbackQuery, text: Optional[str] = None):
+        """Answer the callback query, unless it's too old to answer anymore"""
+        try:
+            self.bot.answer_callback_query(cb_query.id, text=text)
+        except ApiTelegramException as e:
+            if e.error_code != 400 or 'query is too old' not in (e.description or ''):
+                raise
+            self.log.msg(
+                "callback query expired before it was answered",
+                chat_id=cb_query.message.chat.id,
+            )
+
     @retry
     def set_theme(self, cb_query: CallbackQuery):
-        data = yload(cb_query.data)
+        data = cbload(cb_query.data)
         user = cb_query.message.reply_to_message.from_user
         self.log.msg(
             "setting theme",
@@ -540,8 +2729,8 @@ class ColorCodeBot:
             reply_markup=minikb('theme'),
         )
         self.user_themes[user.id] = data['theme']
-        self.bot.answer_callback_query(
-            cb_query.id, text=self.lang['acknowledge theme'].format(data['theme'])
+        self.answer_callback(
+            cb_query, text=self.lang['acknowledge theme'].format(data['theme'])
         )
 
     @retry
@@ -554,7 +2743,7 @@ class ColorCodeBot:
                 reply_to_msg_user_id=cb_query.message.reply_to_message.from_user.id
             )
         except AttributeError as e:
-            has_permission = is_from_group_admin_or_creator(self.bot, cb_query)
+            has_permission = is_from_group_admin_or_creator(self.admins, cb_query)
             log = self.log.bind(query_is_from_admin=has_permission, exc_info=e)
         log.msg("Got deletion request", user_id=cb_query.from_user.id)
         if has_permission:
@@ -562,18 +2751,58 @@ class ColorCodeBot:
                 cb_query.message.chat.id, cb_query.message.message_id
             )
 
+    @METRICS.timed('ccb_stage_seconds', stage='guess_ext')
     def guess_ext(self, code: str, probability_min: float = 0.12) -> Optional[str]:
-        syntax, probability = self.guesser.probabilities(code)[0]
+        key = snippet_hash(code)
+        ext = self.guess_cache.get(key, MISSING)
+        if ext is not MISSING:
+            METRICS.count('ccb_guesses_total', source='cache')
+            self.log.msg(
+                "guessed syntax",
+                stage='cache',
+                ext=ext,
+                guess_cache=self.guess_cache.stats(),
+            )
+            return ext
+        ext = preclassify_ext(code, self.syntax_names)
+        if ext:
+            METRICS.count('ccb_guesses_total', source='preclassifier')
+            self.log.msg("guessed syntax", stage='preclassifier', ext=ext)
+        else:
+            try:
+                ext = self.model_guess_ext(code, probability_min)
+            except Exception as e:
+                # Don't cache this fallback, so the model gets a say once it's ready
+                self.log.msg("guesslang model unavailable", exc_info=e)
+                return self.prefix_guess_ext(code)
+        self.guess_cache[key] = ext
+        return ext
+
+    def model_guess_ext(self, code: str, probability_min: float = 0.12) -> Optional[str]:
+        """
+        Guess with the model, falling back to prefixes if it's unsure;
+        raise if the model isn't ready in time, or fails
+        """
+        self.guess_service.ready.result(
+            timeout=self.tuning['guesslang']['ready wait seconds']
+        )
+        with METRICS.timer('ccb_stage_seconds', stage='guesslang'):
+            syntax, probability = self.guess_service.submit(code).result()[0]
         ext = self.guesslang_syntaxes.get(syntax)
         self.log.msg(
             "guessed syntax",
+            stage='model',
             probability_min=probability_min,
             probability=probability,
             syntax=syntax,
             ext=ext,
         )
         if probability >= probability_min:
+            METRICS.count('ccb_guesses_total', source='model')
             return ext
+        return self.prefix_guess_ext(code)
+
+    def prefix_guess_ext(self, code: str) -> Optional[str]:
         for start, ext in {
             # fmt: off
             '{':     'json',
@@ -587,11 +2816,14 @@ class ColorCodeBot:
             # fmt: on
         }.items():
             if code.startswith(start):
-                self.log.msg("simple-guessed syntax", ext=ext)
+                METRICS.count('ccb_guesses_total', source='prefix')
+                self.log.msg("simple-guessed syntax", stage='prefix', ext=ext)
                 return ext
+        METRICS.count('ccb_guesses_total', source='none')
 
-    @retry
+    @METRICS.timed('ccb_stage_seconds', stage='intake_snippet')
     def intake_snippet(self, message: Message):
+        explicit = False
         if self.ignore_mode_groups.get(message.chat.id, False):
             if (
                 self.group_user_current_watchme_requests.get(
@@ -600,6 +2832,7 @@ class ColorCodeBot:
                 != 'watch'
             ):
                 return
+            explicit = True
         elif (
             self.group_user_current_watchme_requests.get(
                 f"{message.chat.id}:{message.from_user.id}", 'watch'
@@ -612,20 +2845,70 @@ class ColorCodeBot:
             text_content = code_subcontent(message)
             if not text_content:
                 return
+        self.admission.submit(
+            admission_priority(message.chat, explicit),
+            message.chat.id,
+            message.date,
+            functools.partial(self.answer_snippet, message, text_content),
+        )
+
+    @METRICS.timed('ccb_stage_seconds', stage='answer_snippet')
+    @retry
+    def answer_snippet(self, message: Message, text_content: str):
+        """Guess the snippet's syntax, and reply with a syntax picker and renders"""
         self.log.msg(
             "receiving code",
             user_id=message.from_user.id,
             user_first_name=message.from_user.first_name,
             chat_id=message.chat.id,
+            settings_cache=self.settings_cache_stats(),
         )
         ext = self.guess_ext(text_content)
         if not ext:
             with suppress(KeyError):
                 ext = self.group_syntaxes[message.chat.id]
+        self.offer_syntax(message, ext)
+
+    @METRICS.timed('ccb_stage_seconds', stage='intake_document')
+    def intake_document(self, message: Message):
+        document = message.document
+        suffix = os.path.splitext(document.file_name or '')[1].lstrip('.').lower()
+        ext = self.syntax_names.get(suffix)
+        if not (
+            ext
+            or (document.mime_type or '').startswith('text/')
+            or document.mime_type in CODE_MIME_TYPES
+        ):
+            return
+        self.log.msg(
+            "receiving code file",
+            user_id=message.from_user.id,
+            user_first_name=message.from_user.first_name,
+            chat_id=message.chat.id,
+            file_size=document.file_size,
+            mime_type=document.mime_type,
+        )
+        if (document.file_size or 0) > self.tuning['paging']['max document bytes']:
+            self.bot.reply_to(
+                message, self.lang['file too large'], parse_mode='MarkdownV2'
+            )
+            return
+        self.admission.submit(
+            admission_priority(message.chat),
+            message.chat.id,
+            message.date,
+            functools.partial(self.offer_syntax, message, ext),
+        )
+
+    def offer_syntax(self, message: Message, ext: Optional[str] = None):
+        """
+        Reply to the code message with a syntax picker,
+        and colorize it right away if the syntax is already known.
+        """
         if ext:
             kb_msg = self.bot.reply_to(
                 message,
-                f"{self.lang['query ext']}\n\n{self.lang['guessed syntax'].format(ext)}",
+                self.query_guessed_ext_md.format(ext),
                 reply_markup=minikb('syntax', self.lang['syntax picker']),
                 parse_mode='MarkdownV2',
                 disable_web_page_preview=True,
@@ -639,7 +2922,7 @@ class ColorCodeBot:
                 parse_mode='MarkdownV2',
                 disable_web_page_preview=True,
             )
-        Thread(target=delete_after_delay, args=(self.bot, kb_msg, 30, self.log)).start()
+        self.deletions.schedule(kb_msg, self.tuning['deletions']['delay seconds'])
 
     @retry
     def send_photo_elsewhere(self, inline_query: InlineQuery):
@@ -661,18 +2944,18 @@ class ColorCodeBot:
 
     @retry
     def restore_kb(self, cb_query: CallbackQuery):
-        data = yload(cb_query.data)
+        data = cbload(cb_query.data)
         self.bot.edit_message_reply_markup(
             cb_query.message.chat.id,
             cb_query.message.message_id,
             reply_markup=self.kb[data['kb_name']],
         )
-        self.bot.answer_callback_query(cb_query.id)
+        self.answer_callback(cb_query)
 
     @retry
     def set_group_syntax(self, cb_query: CallbackQuery):
-        ext = yload(cb_query.data)['ext']
-        is_admin_or_creator = is_from_group_admin_or_creator(self.bot, cb_query)
+        ext = cbload(cb_query.data)['ext']
+        is_admin_or_creator = is_from_group_admin_or_creator(self.admins, cb_query)
         self.log.msg(
             "user trying to set group default syntax",
             ext=ext,
@@ -693,6 +2976,21 @@ class ColorCodeBot:
                 reply_markup=self.kb['group options'],
             )
 
+    def request_snippet_filetype(self, cb_query: CallbackQuery):
+        """Queue colorizing the snippet in the chosen syntax, as an explicit request"""
+        admitted = self.admission.submit(
+            admission_priority(cb_query.message.chat, explicit=True),
+            cb_query.message.chat.id,
+            None,
+            functools.partial(self.set_snippet_filetype, cb_query),
+        )
+        # Answer now, as the job may wait longer than Telegram waits for an answer:
+        if admitted:
+            self.answer_callback(cb_query)
+        else:
+            self.answer_callback(cb_query, text=self.lang['busy'])
+
+    @METRICS.timed('ccb_stage_seconds', stage='set_snippet_filetype')
     @retry
     def set_snippet_filetype(
         self,
@@ -702,7 +3000,7 @@ class ColorCodeBot:
     ):
         if cb_query:
             query_message = cb_query.message
-            ext = yload(cb_query.data)['ext']
+            ext = cbload(cb_query.data)['ext']
             self.bot.edit_message_reply_markup(
                 query_message.chat.id,
                 query_message.message_id,
@@ -717,58 +3015,410 @@ class ColorCodeBot:
             user_first_name=query_message.reply_to_message.from_user.first_name,
             syntax=ext,
             chat_id=query_message.chat.id,
+            render_pool=self.render_pool.stats(),
+            png_optimizer=self.png_optimizer.stats(),
+            rate_limiter=self.limiter.stats(),
         )
 
         snippet = query_message.reply_to_message
-        text_content = snippet.text
+        if snippet.content_type == 'document':
+            with self.fetched_document(snippet.document) as source:
+                with open(source, encoding='utf-8', errors='replace') as lines:
+                    pages, truncated = paginate(lines, ext, **self.page_limits)
+                self.colorize(
+                    snippet,
+                    ext,
+                    pages,
+                    truncated,
+                    functools.partial(
+                        self.render_html_file, source, snippet.document.file_unique_id
+                    ),
+                )
+        else:
+            text_content = snippet.text
+            if snippet.chat.type != 'private':
+                text_content = code_subcontent(snippet)
+            pages, truncated = paginate(
+                text_content.splitlines(keepends=True), ext, **self.page_limits
+            )
+            self.colorize(
+                snippet,
+                ext,
+                pages,
+                truncated,
+                functools.partial(self.render_html, text_content),
+            )
+
+    def colorize(
+        self,
+        snippet: Message,
+        ext: str,
+        pages: List[tuple[int, str]],
+        truncated: bool,
+        render_html: Callable[..., tuple[str, Render]],
+    ):
+        """
+        Render the snippet as HTML and images, and send them in reply.
+        Long snippets are rendered as an album of pages, but as a single HTML file.
+        """
         do_send_html, do_send_image_dark, do_send_image_light, do_attach_send_kb = (
             True,
         ) * 4
         if snippet.chat.type != 'private':
-            text_content = code_subcontent(snippet)
             do_send_html, do_send_image_light, do_attach_send_kb = (False,) * 3
         theme = self.user_themes.get(snippet.from_user.id, 'base16/bright')
 
+        image_themes = []
+        if do_send_image_dark:
+            image_themes.append('Coldark-Dark')
+        if do_send_image_light:
+            image_themes.append('Coldark-Cold')
+
+        # Render everything at once, but send results in a stable order,
+        # each as soon as it and its predecessors are ready:
+        deadline = monotonic() + self.tuning['pipeline']['deadline seconds']
+        jobs = []
         if do_send_html:
-            html = mk_html(text_content, ext, theme)
-            send_html(
-                bot=self.bot,
+            jobs.append(('html', [self.pipeline.submit(render_html, ext, theme)]))
+        for image_theme in image_themes:
+            jobs.append(
+                (
+                    image_theme,
+                    [
+                        self.pipeline.submit(
+                            self.render_png, code, ext, image_theme, line_offset=offset
+                        )
+                        for offset, code in pages
+                    ],
+                )
+            )
+        for name, futures in jobs:
+            try:
+                results = [
+                    future.result(timeout=max(0, deadline - monotonic()))
+                    for future in futures
+                ]
+            except TimeoutError:
+                for future in futures:
+                    future.cancel()
+                self.log.error(
+                    "render missed its deadline",
+                    render=name,
+                    syntax=ext,
+                    chat_id=snippet.chat.id,
+                )
+                continue
+            rerenders = [
+                functools.partial(
+                    self.render_png,
+                    code,
+                    ext,
+                    name,
+                    by_reference=False,
+                    line_offset=offset,
+                )
+                for offset, code in pages
+            ]
+            if name == 'html':
+                self.send_html_render(
+                    snippet,
+                    *results[0],
+                    rerender=functools.partial(
+                        render_html, ext, theme, by_reference=False
+                    ),
+                )
+            elif len(results) == 1:
+                self.send_render(
+                    snippet, *results[0], do_attach_send_kb, rerender=rerenders[0]
+                )
+            elif results:
+                self.send_pages(snippet, results, rerenders)
+        if truncated and image_themes:
+            last_offset, last_code = pages[-1]
+            last_line = last_offset + last_code.count('\n')
+            self.log.msg(
+                "rendered only the first pages of code",
+                pages=len(pages),
+                last_line=last_line,
                 chat_id=snippet.chat.id,
-                html=html,
-                reply_msg_id=snippet.message_id,
+            )
+            self.bot.send_message(
+                snippet.chat.id,
+                self.lang['truncated'].format(last_line),
+                parse_mode='MarkdownV2',
+                reply_to_message_id=snippet.message_id,
+                reply_markup=BEGONE_KB,
             )
 
-        themes = []
-        if do_send_image_dark:
-            themes.append('Coldark-Dark')
-        if do_send_image_light:
-            themes.append('Coldark-Cold')
-        with local.tempdir() as folder:
-            for theme in themes:
-                png_path = mk_png(text_content, ext, theme, folder=folder)
-                photo_msg = send_image(
+    def send_render(
+        self,
+        snippet: Message,
+        key: str,
+        render: Render,
+        do_attach_send_kb: bool,
+        rerender: Callable[[], tuple[str, Render]],
+    ):
+        """
+        Send a rendered image in reply to the snippet, by reference if possible.
+        The keyboard goes out with the image, unless it needs the new upload's file_id.
+        If Telegram no longer accepts the file_id, forget it and upload a fresh render.
+        """
+        if render.file_id:
+            self.log.msg("resending cached image", file_id=render.file_id)
+            image_kb = BEGONE_KB
+            if do_attach_send_kb and render.file_kind == 'photo':
+                image_kb = self.kb['image send'].splice(
+                    FILE_ID_PLACEHOLDER, render.file_id
+                )
+            try:
+                resend_image(
                     bot=self.bot,
                     chat_id=snippet.chat.id,
-                    png_path=png_path,
+                    file_id=render.file_id,
+                    file_kind=render.file_kind,
                     reply_msg_id=snippet.message_id,
-                )
-                image_kb = InlineKeyboardMarkup()
-                if do_attach_send_kb and photo_msg.content_type == 'photo':
-                    image_kb.add(
-                        InlineKeyboardButton(
-                            self.lang['send to chat'],
-                            switch_inline_query=f"img {photo_msg.photo[-1].file_id}",
-                        )
-                    )
-                image_kb.add(BEGONE_BUTTON)
-                self.bot.edit_message_reply_markup(
-                    photo_msg.chat.id,
-                    photo_msg.message_id,
                     reply_markup=image_kb,
                 )
+            except ApiTelegramException as e:
+                if not is_file_reference_error(e):
+                    raise
+                self.log.error(
+                    "cached file_id was rejected", exc_info=e, file_id=render.file_id
+                )
+                self.forget_upload(key)
+            else:
+                return
+        if not render.png:
+            key, render = rerender()
+        photo_msg = send_image(
+            bot=self.bot,
+            chat_id=snippet.chat.id,
+            png=render.png,
+            reply_msg_id=snippet.message_id,
+            reply_markup=BEGONE_KB,
+            log=self.log,
+            limiter=self.limiter,
+        )
+        self.remember_upload(key, photo_msg)
+        if do_attach_send_kb and photo_msg.content_type == 'photo':
+            self.bot.edit_message_reply_markup(
+                photo_msg.chat.id,
+                photo_msg.message_id,
+                reply_markup=self.kb['image send'].splice(
+                    FILE_ID_PLACEHOLDER, photo_msg.photo[-1].file_id
+                ),
+            )
+
+    def send_html_render(
+        self,
+        snippet: Message,
+        key: str,
+        render: Render,
+        rerender: Callable[[], tuple[str, Render]],
+    ):
+        """
+        Send a rendered HTML document in reply to the snippet, by reference if possible.
+        If Telegram no longer accepts the file_id, forget it and upload a fresh render.
+        """
+        if render.file_id:
+            self.log.msg("resending cached document", file_id=render.file_id)
+            try:
+                resend_image(
+                    bot=self.bot,
+                    chat_id=snippet.chat.id,
+                    file_id=render.file_id,
+                    file_kind=render.file_kind,
+                    reply_msg_id=snippet.message_id,
+                    reply_markup=BEGONE_KB,
+                )
+            except ApiTelegramException as e:
+                if not is_file_reference_error(e):
+                    raise
+                self.log.error(
+                    "cached file_id was rejected", exc_info=e, file_id=render.file_id
+                )
+                self.forget_upload(key)
+            else:
+                return
+        if not render.html:
+            key, render = rerender()
+        doc_msg = send_html(
+            bot=self.bot,
+            chat_id=snippet.chat.id,
+            html=render.html,
+            reply_msg_id=snippet.message_id,
+            limiter=self.limiter,
+        )
+        self.remember_upload(key, doc_msg)
+
+    def send_pages(
+        self,
+        snippet: Message,
+        results: List[tuple[str, Render]],
+        rerenders: List[Callable[[], tuple[str, Render]]],
+        by_reference: bool = True,
+    ):
+        """
+        Send rendered pages in reply to the snippet, as one album,
+        with each page sent by reference if possible.
+        An album can't mix photos and documents,
+        so if any page can't be a photo, they're all sent as documents.
+        If Telegram no longer accepts the file_ids, forget them and upload fresh renders.
+        """
+        kind = (
+            'photo'
+            if all(
+                render.file_kind == 'photo' if render.file_id else fits_photo(render.png)
+                for _, render in results
+            )
+            else 'document'
+        )
+        media, uploads = [], []
+        for (key, render), rerender in zip(results, rerenders):
+            if by_reference and render.file_id and render.file_kind == kind:
+                media.append(render.file_id)
+                continue
+            if not render.png:
+                key, render = rerender()
+            page = io.BytesIO(render.png)
+            page.name = f'code-{len(media) + 1}.png'
+            uploads.append((len(media), key))
+            media.append(page)
+        send_chat_action(self.bot, snippet.chat.id, f'upload_{kind}', self.limiter)
+        input_media = InputMediaPhoto if kind == 'photo' else InputMediaDocument
+        try:
+            with METRICS.timer('ccb_stage_seconds', stage='send_pages'):
+                msgs = self.bot.send_media_group(
+                    snippet.chat.id,
+                    [input_media(item) for item in media],
+                    reply_to_message_id=snippet.message_id,
+                )
+        except ApiTelegramException as e:
+            if len(uploads) == len(media) or not is_file_reference_error(e):
+                raise
+            self.log.error("cached file_ids were rejected", exc_info=e)
+            for key, render in results:
+                if render.file_id:
+                    self.forget_upload(key)
+            self.send_pages(snippet, results, rerenders, by_reference=False)
+            return
+        for i, key in uploads:
+            self.remember_upload(key, msgs[i])
 
-        if cb_query:
-            self.bot.answer_callback_query(cb_query.id)
+    def remember_upload(self, key: str, message: Message):
+        """Store the file_id of an uploaded render, in memory and in the DB"""
+        self.render_cache.remember_upload(key, message)
+        file_kind, file_id = message_file_id(message)
+        self.file_ids[key] = f"{file_kind}:{file_id}"
+
+    def forget_upload(self, key: str):
+        self.render_cache.forget_upload(key)
+        with suppress(KeyError):
+            del self.file_ids[key]
+
+    def render_png(
+        self,
+        code: str,
+        ext: str,
+        theme: str,
+        by_reference: bool = True,
+        line_offset: int = 1,
+    ) -> tuple[str, Render]:
+        """
+        Return the render cache key and PNG render, from the cache if possible.
+        If the image has been uploaded before, the render may be just its file_id,
+        unless by_reference is False.
+        """
+        key = render_key('silicon', code, ext, theme, *line_offset_flags(line_offset))
+        render = self.render_cache.get(key)
+        if render and not (render.png or by_reference):
+            render = None
+        if not render and by_reference:
+            render = self.uploaded_render(key)
+        if not render:
+            render = Render(
+                png=mk_png(
+                    code,
+                    ext,
+                    theme,
+                    pool=self.render_pool,
+                    optimizer=self.png_optimizer,
+                    line_offset=line_offset,
+                )
+            )
+            self.render_cache.put(key, render)
+        return key, render
+
+    def render_html(
+        self, code: str, ext: str, theme: str, by_reference: bool = True
+    ) -> tuple[str, Render]:
+        """
+        Return the render cache key and HTML render, from the cache if possible.
+        If the document has been uploaded before, the render may be just its file_id,
+        unless by_reference is False.
+        """
+        key = render_key('highlight', code, ext, theme)
+        render = self.render_cache.get(key)
+        if render and not (render.html or by_reference):
+            render = None
+        if not render and by_reference:
+            render = self.uploaded_render(key)
+        if not render:
+            render = Render(html=mk_html(code, ext, theme, pool=self.render_pool))
+            self.render_cache.put(key, render)
+        return key, render
+
+    def render_html_file(
+        self,
+        path: LocalPath,
+        file_unique_id: str,
+        ext: str,
+        theme: str,
+        by_reference: bool = True,
+    ) -> tuple[str, Render]:
+        """
+        Return a key and HTML render for a whole file, identified by its Telegram ID.
+        Whole files aren't kept in the render cache, but their uploads are remembered.
+        """
+        key = render_key('highlight', f"file:{file_unique_id}", ext, theme)
+        render = self.uploaded_render(key) if by_reference else None
+        return key, render or Render(
+            html=mk_html_file(path, ext, theme, pool=self.render_pool)
+        )
+
+    def uploaded_render(self, key: str) -> Optional[Render]:
+        """Return a render of just the file_id it was uploaded as, if it has been"""
+        uploaded = self.file_ids.get(key)
+        if uploaded:
+            file_kind, file_id = uploaded.split(':', 1)
+            return Render(file_id=file_id, file_kind=file_kind)
+
+    @contextmanager
+    def fetched_document(self, document: Document) -> Iterator[LocalPath]:
+        """Provide the document as a local file, downloading it in chunks if needed"""
+        file_path = self.bot.get_file(document.file_id).file_path
+        if os.path.isabs(file_path) and local.path(file_path).is_file():
+            # A local Bot API server hands out paths to its own copies
+            yield local.path(file_path)
+            return
+        path = scratch_folder('ccb_docs') / f'{uuid4()}'
+        try:
+            with self.transport.session.get(
+                (apihelper.FILE_URL or DEFAULT_FILE_URL).format(
+                    self.bot.token, file_path
+                ),
+                stream=True,
+                timeout=(self.transport.connect_timeout, self.transport.upload_timeout),
+            ) as resp:
+                resp.raise_for_status()
+                with path.open('wb') as f:
+                    for chunk in resp.iter_content(
+                        self.tuning['paging']['download chunk bytes']
+                    ):
+                        f.write(chunk)
+            yield path
+        finally:
+            path.delete()
 
     def recv_photo(self, message: Message):
         self.log.msg(
@@ -780,13 +3430,369 @@ class ColorCodeBot:
         )
 
 
+def update_chat_id(
+    update: Union[Message, CallbackQuery, InlineQuery, ChatMemberUpdated]
+) -> int:
+    """Return the ID of the chat an update belongs to, or of its user if there's none"""
+    if isinstance(update, (Message, ChatMemberUpdated)):
+        return update.chat.id
+    if isinstance(update, CallbackQuery) and update.message:
+        return update.message.chat.id
+    return update.from_user.id
+
+
+def shard_for(chat_id: int, shards: int) -> int:
+    return chat_id % shards
+
+
+class Dispatcher:
+    """
+    Long poll for updates, and forward each to one of several webhook mode workers,
+    chosen by chat ID, so each chat's updates are handled in order by one worker.
+    Forwarding to each worker happens in order on its own thread,
+    retrying while that worker is down or busy.
+    Once a worker's queue is full, its further updates are dropped,
+    so polling carries on for the other workers.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        worker_urls: List[str],
+        secret_token: str,
+        poll_timeout: int = 30,
+        queue_size: int = 1024,
+        log: Optional[BindableLogger] = None,
+    ):
+        self.api_key = api_key
+        self.secret_token = secret_token
+        self.poll_timeout = poll_timeout
+        self.log = log
+        self.queues = [Queue(maxsize=queue_size) for _ in worker_urls]
+        self.forwarders = [
+            Thread(
+                target=self._forward, args=(url, queue), name=f'forward-{i}', daemon=True
+            )
+            for i, (url, queue) in enumerate(zip(worker_urls, self.queues))
+        ]
+        for forwarder in self.forwarders:
+            forwarder.start()
+        for i, queue in enumerate(self.queues):
+            METRICS.gauge('ccb_forward_queue_depth', queue.qsize, worker=str(i))
+
+    def dispatch(self, raw_update: Mapping):
+        update = Update.de_json(raw_update)
+        content = (
+            update.message
+            or update.callback_query
+            or update.inline_query
+            or update.chat_member
+        )
+        chat_id = update_chat_id(content) if content else 0
+        shard = shard_for(chat_id, len(self.queues))
+        try:
+            self.queues[shard].put_nowait(raw_update)
+        except Full:
+            METRICS.count('ccb_forward_dropped_total', worker=str(shard))
+            if self.log:
+                self.log.error(
+                    "dropped update for a backed up worker",
+                    worker=shard,
+                    update_id=raw_update['update_id'],
+                    chat_id=chat_id,
+                )
+
+    def run(self):
+        offset = None
+        while True:
+            try:
+                raw_updates = apihelper.get_updates(
+                    self.api_key,
+                    offset=offset,
+                    timeout=self.poll_timeout,
+                    allowed_updates=ALLOWED_UPDATES,
+                    long_polling_timeout=self.poll_timeout,
+                )
+            except (ApiException, requests.RequestException) as e:
+                if self.log:
+                    self.log.error("failed to get updates", exc_info=e)
+                sleep(1)
+                continue
+            for raw_update in raw_updates:
+                self.dispatch(raw_update)
+                offset = raw_update['update_id'] + 1
+
+    def _forward(self, url: str, queue: Queue):
+        session = requests.Session()
+        while True:
+            raw_update = queue.get()
+            attempt = 0
+            while True:
+                try:
+                    session.post(
+                        url,
+                        json=raw_update,
+                        headers={'X-Telegram-Bot-Api-Secret-Token': self.secret_token},
+                        timeout=10,
+                    ).raise_for_status()
+                except requests.RequestException as e:
+                    if self.log:
+                        self.log.error(
+                            "failed to forward update", exc_info=e, worker_url=url
+                        )
+                    METRICS.count(
+                        'ccb_retries_total', function='forward', cause=type(e).__name__
+                    )
+                    sleep(retry_delay(e, attempt, requests.RequestException, 1, 30))
+                    attempt += 1
+                else:
+                    break
+
+
+class AsyncRunner:
+    """
+    Receive and dispatch updates with AsyncTeleBot,
+    running ColorCodeBot's blocking handlers on an executor:
+    one at a time per chat, in arrival order, and no more than concurrency at once.
+    """
+
+    def __init__(self, ccb: ColorCodeBot, api_key: str, concurrency: int = 8):
+        # Only async mode needs aiohttp, which AsyncTeleBot imports
+        from telebot import asyncio_helper
+        from telebot.async_telebot import AsyncTeleBot
+
+        # Receive from the same Bot API server that Transport sends to
+        if ccb.transport.api_url:
+            asyncio_helper.API_URL = f"{ccb.transport.api_url}/bot{{0}}/{{1}}"
+            asyncio_helper.FILE_URL = f"{ccb.transport.api_url}/file/bot{{0}}/{{1}}"
+        self.ccb = ccb
+        self.bot = AsyncTeleBot(api_key)
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='handler'
+        )
+        self.limit = asyncio.Semaphore(concurrency)
+        self.chat_tails: dict[int, asyncio.Future] = {}
+        for kind, filters, handler in self.ccb.handler_specs():
+            getattr(self.bot, f'{kind}_handler')(**filters)(self.in_chat_order(handler))
+
+    def in_chat_order(self, handler: Callable) -> Callable:
+        async def run(update):
+            chat_id = update_chat_id(update)
+            previous = self.chat_tails.get(chat_id)
+            done = asyncio.get_running_loop().create_future()
+            self.chat_tails[chat_id] = done
+            try:
+                if previous:
+                    await previous
+                async with self.limit:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self.executor, handler, update
+                    )
+            except Exception as e:
+                self.ccb.log.error(
+                    "handler failed",
+                    handler=handler.__name__,
+                    exc_info=e,
+                    chat_id=chat_id,
+                )
+            finally:
+                done.set_result(None)
+                if self.chat_tails.get(chat_id) is done:
+                    del self.chat_tails[chat_id]
+
+        return run
+
+    def run(self):
+        asyncio.run(self.bot.infinity_polling(allowed_updates=ALLOWED_UPDATES))
+
+
+class WebhookServer:
+    """
+    Accept updates POSTed by Telegram, check their secret token,
+    and acknowledge each as soon as it's queued for a worker thread to process.
+    """
+
+    def __init__(
+        self,
+        process_updates: Callable[[List[Update]], Any],
+        secret_token: str,
+        host: str = '127.0.0.1',
+        port: int = 8443,
+        path: str = '/',
+        queue_size: int = 1024,
+        log: Optional[BindableLogger] = None,
+    ):
+        self.process_updates = process_updates
+        self.secret_token = secret_token
+        self.path = path
+        self.log = log
+        self.updates = Queue(maxsize=queue_size)
+        self.httpd = ThreadingHTTPServer((host, port), self.mk_request_handler())
+        self.worker = Thread(target=self._work, name='webhook', daemon=True)
+        METRICS.gauge('ccb_webhook_queue_depth', self.updates.qsize)
+
+    def mk_request_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self.send_error(404)
+                if not hmac.compare_digest(
+                    self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''),
+                    server.secret_token,
+                ):
+                    return self.send_error(403)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    server.updates.put_nowait((body, monotonic()))
+                except Full:
+                    # Telegram will redeliver it later
+                    METRICS.count('ccb_webhook_updates_total', outcome='rejected')
+                    return self.send_error(503)
+                METRICS.count('ccb_webhook_updates_total', outcome='received')
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookRequestHandler
+
+    def _work(self):
+        while True:
+            body, received = self.updates.get()
+            try:
+                self.process_updates([Update.de_json(body.decode())])
+            except Exception as e:
+                METRICS.count('ccb_webhook_updates_total', outcome='failed')
+                if self.log:
+                    self.log.error("failed to process webhook update", exc_info=e)
+            else:
+                METRICS.count('ccb_webhook_updates_total', outcome='processed')
+            METRICS.observe(
+                'ccb_stage_seconds', monotonic() - received, stage='webhook_update'
+            )
+            if self.log:
+                self.log.msg(
+                    "processed webhook update",
+                    seconds=monotonic() - received,
+                    queue_depth=self.updates.qsize(),
+                )
+
+    def serve_forever(self):
+        self.worker.start()
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 if __name__ == '__main__':
+    parser = ArgumentParser(description="Run Color Code Bot")
+    parser.add_argument(
+        '--mode',
+        choices=('polling', 'async', 'webhook', 'dispatcher', 'worker'),
+        default='polling',
+        help=(
+            "receive and handle updates with TeleBot threads, or AsyncTeleBot,"
+            " or receive them with a local webhook server"
+            " (set WEBHOOK_SECRET, and WEBHOOK_URL to register it with Telegram);"
+            " or run sharded, as a dispatcher forwarding updates to workers"
+            " (set WEBHOOK_SECRET for both)"
+        ),
+    )
+    parser.add_argument(
+        '--shard', type=int, default=0, help="in worker mode, which worker this is"
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        help="how many workers there are (default: from tuning.yml)",
+    )
+    args = parser.parse_args()
     cfg = load_configs()
-    ColorCodeBot(
-        api_key=os.environ['TG_API_KEY'],
-        admin_chat_id=os.environ.get('ADMIN_CHAT_ID'),
-        lang=cfg['lang'],
-        theme_image_ids=cfg['theme_image_ids'],
-        keyboards=cfg['kb'],
-        guesslang_syntaxes=cfg['guesslang'],
-    ).bot.polling()
+    shards = args.shards or cfg['tuning']['sharding']['workers']
+    metrics_port = cfg['tuning']['metrics'].get('port')
+    if metrics_port is not None and args.mode == 'worker':
+        metrics_port += 1 + args.shard
+    MetricsExporter(
+        METRICS,
+        host=cfg['tuning']['metrics']['host'],
+        port=metrics_port,
+        log_interval=cfg['tuning']['metrics'].get('log interval seconds'),
+        log=mk_logger(),
+    ).start()
+    if args.mode == 'dispatcher':
+        Transport(
+            pool_size=cfg['tuning']['transport']['pool size'],
+            keep_alive=cfg['tuning']['transport']['keep alive'],
+            connect_timeout=cfg['tuning']['transport']['connect timeout seconds'],
+            read_timeout=cfg['tuning']['transport']['read timeout seconds'],
+            upload_timeout=cfg['tuning']['transport']['upload timeout seconds'],
+            api_url=cfg['tuning']['transport'].get('api url'),
+            flood_waits=cfg['tuning']['transport']['flood control waits'],
+            max_flood_wait=cfg['tuning']['transport']['max flood wait seconds'],
+        ).install()
+        Dispatcher(
+            os.environ['TG_API_KEY'],
+            [
+                "http://{host}:{port}{path}".format(
+                    host=cfg['tuning']['sharding']['host'],
+                    port=cfg['tuning']['sharding']['base port'] + shard,
+                    path=cfg['tuning']['sharding']['path'],
+                )
+                for shard in range(shards)
+            ],
+            os.environ['WEBHOOK_SECRET'],
+            poll_timeout=cfg['tuning']['sharding']['poll timeout seconds'],
+            queue_size=cfg['tuning']['sharding']['queue size'],
+            log=mk_logger(),
+        ).run()
+    else:
+        ccb = ColorCodeBot(
+            api_key=os.environ['TG_API_KEY'],
+            admin_chat_id=os.environ.get('ADMIN_CHAT_ID'),
+            lang=cfg['lang'],
+            theme_image_ids=cfg['theme_image_ids'],
+            keyboards=cfg['kb'],
+            guesslang_syntaxes=cfg['guesslang'],
+            tuning=cfg['tuning'],
+            shard=(args.shard, shards) if args.mode == 'worker' else None,
+            # A worker handles its chats' updates one at a time, in order:
+            threaded=args.mode != 'worker',
+        )
+        if args.mode == 'async':
+            AsyncRunner(
+                ccb, os.environ['TG_API_KEY'], cfg['tuning']['async']['concurrency']
+            ).run()
+        elif args.mode == 'worker':
+            WebhookServer(
+                ccb.bot.process_new_updates,
+                os.environ['WEBHOOK_SECRET'],
+                host=cfg['tuning']['sharding']['host'],
+                port=cfg['tuning']['sharding']['base port'] + args.shard,
+                path=cfg['tuning']['sharding']['path'],
+                queue_size=cfg['tuning']['sharding']['queue size'],
+                log=ccb.log.bind(shard=args.shard),
+            ).serve_forever()
+        elif args.mode == 'webhook':
+            if os.environ.get('WEBHOOK_URL'):
+                ccb.bot.set_webhook(
+                    os.environ['WEBHOOK_URL'],
+                    secret_token=os.environ['WEBHOOK_SECRET'],
+                    allowed_updates=ALLOWED_UPDATES,
+                )
+            WebhookServer(
+                ccb.bot.process_new_updates,
+                os.environ['WEBHOOK_SECRET'],
+                host=cfg['tuning']['webhook']['host'],
+                port=cfg['tuning']['webhook']['port'],
+                path=cfg['tuning']['webhook']['path'],
+                queue_size=cfg['tuning']['webhook']['queue size'],
+                log=ccb.log,
+            ).serve_forever()
+        else:
+            ccb.bot.polling(allowed_updates=ALLOWED_UPDATES)
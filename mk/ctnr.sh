@@ -40,7 +40,7 @@ today=$(date +%Y.%j)
 tz="America/New_York"
 
 base_img='docker.io/library/archlinux:base'
-pkgs='highlight python silicon sops ttf-nerd-fonts-symbols-1000-em-mono'
+pkgs='highlight oxipng pngquant python silicon sops ttf-nerd-fonts-symbols-1000-em-mono'
 aur_pkgs='otf-openmoji s6 ttf-nanumgothic_coding'
 build_pkgs='git'
 build_groups='base-devel'
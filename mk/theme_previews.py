@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Render a preview image for each HTML theme, upload the new or changed ones,
+and write their file IDs back to vars.<deployment>.yml (for mk/file_ids.sh).
+
+Previews are rendered by highlight as SVG and converted by rsvg-convert,
+in parallel on the bot's render pool, then optimized and uploaded like the bot's images.
+Each preview's content hash (theme, sample, flags, renderer versions)
+is saved next to its file ID, so unchanged previews are neither rendered nor uploaded.
+
+Run with the app's venv active, and TG_API_KEY set.
+"""
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from typing import Mapping, Optional
+from uuid import uuid4
+
+from plumbum import local
+from plumbum.cmd import highlight
+from plumbum.machines import LocalCommand
+from telebot import TeleBot
+
+sys.path.insert(0, str(local.path(__file__).up(2) / 'app'))
+
+from colorcodebot import (  # noqa: E402
+    PngOptimizer, RateLimiter, RenderPool, Transport, load_configs,
+    message_file_id, optional_command, renderer_version,
+    run_renderer, scratch_folder, send_image, ydump, yload
+)
+
+SAMPLE = '''\
+from dataclasses import dataclass
+
+
+@dataclass
+class Snippet:
+    """Some code, and what it's written in"""
+
+    code: str
+    syntax: str = 'py'
+
+    def lines(self) -> int:
+        return len(self.code.splitlines()) if self.code else 0
+
+
+for i, snippet in enumerate([Snippet('print("Hello!")'), Snippet('')]):
+    print(f"{i:>2}: {snippet.lines()} line(s) of {snippet.syntax!r}")
+'''
+
+PREVIEW_FLAGS = (
+    '--syntax=py',
+    '--line-numbers',
+    '--out-format=svg',
+    '--include-style',
+    '--encoding=UTF-8',
+)
+
+
+def preview_hash(theme: str, versions: tuple[str, ...]) -> str:
+    """Return a hash of everything that goes into a theme's preview"""
+    return sha256(
+        json.dumps([theme, SAMPLE, PREVIEW_FLAGS, versions]).encode()
+    ).hexdigest()
+
+
+def mk_preview(
+    theme: str,
+    rsvg_convert: LocalCommand,
+    pool: Optional[RenderPool] = None,
+    optimizer: Optional[PngOptimizer] = None,
+) -> bytes:
+    """Return PNG image data of the sample code, titled and highlighted in the theme"""
+    png = scratch_folder('ccb_png') / f'{uuid4()}.png'
+    try:
+        svg = run_renderer(
+            highlight[f"--style={theme}", PREVIEW_FLAGS], f"# {theme}\n\n{SAMPLE}", pool
+        )
+        run_renderer(rsvg_convert['--zoom=2', '--output', png], svg, pool)
+        if optimizer:
+            optimizer.optimize(png)
+        return png.read(mode='rb')
+    finally:
+        png.delete()
+
+
+def replace_section(text: str, key: str, data: Mapping[str, str]) -> str:
+    """
+    Replace the top-level mapping under key in the YAML text, or append it,
+    leaving everything else (layout, comments) as it was
+    """
+    section = ydump({key: dict(data)}).splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    start = next((i for i, line in enumerate(lines) if line.startswith(f"{key}:")), None)
+    if start is None:
+        return ''.join((*lines, '\n', *section))
+    end = start + 1
+    while end < len(lines) and (not lines[end].strip() or lines[end][0] == ' '):
+        end += 1
+    while not lines[end - 1].strip():
+        end -= 1
+    return ''.join((*lines[:start], *section, *lines[end:]))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--deployment', default='dev')
+    parser.add_argument(
+        '--theme',
+        action='append',
+        default=[],
+        help="a theme to add, beyond those already listed (repeatable)",
+    )
+    parser.add_argument(
+        '--force', action='store_true', help="render and upload every preview"
+    )
+    parser.add_argument(
+        '--chat',
+        default=os.environ.get('ADMIN_CHAT_ID'),
+        help="chat to upload to (default: $ADMIN_CHAT_ID)",
+    )
+    parser.add_argument(
+        '--api-url', help="Bot API server to upload to (default: from tuning.yml)"
+    )
+    args = parser.parse_args()
+    if not args.chat:
+        parser.error("a chat to upload to is required (--chat or $ADMIN_CHAT_ID)")
+
+    rsvg_convert = optional_command('rsvg-convert')
+    if not rsvg_convert:
+        sys.exit("rsvg-convert (from librsvg) is required")
+
+    vars_file = local.path(__file__).up(2) / f'vars.{args.deployment}.yml'
+    text = vars_file.read()
+    deployment_vars = yload(text)
+    file_ids = dict(deployment_vars.get('theme_previews') or {})
+    hashes = dict(deployment_vars.get('theme_preview_hashes') or {})
+    for theme in args.theme:
+        file_ids.setdefault(theme, '')
+
+    versions = (
+        renderer_version('highlight'),
+        rsvg_convert('--version').strip(),
+    )
+    digests = {theme: preview_hash(theme, versions) for theme in file_ids}
+    stale = [
+        theme
+        for theme in file_ids
+        if args.force or not file_ids[theme] or hashes.get(theme) != digests[theme]
+    ]
+    print(f"{len(stale)} of {len(file_ids)} previews to render and upload")
+
+    tuning = load_configs()['tuning']
+    pool = RenderPool(
+        workers=tuning['render pool']['workers'],
+        queue_size=tuning['render pool']['queue size'],
+        timeout=tuning['render pool']['timeout seconds'],
+    )
+    optimizer = PngOptimizer(
+        quantize_quality=tuning['png optimizer'].get('quantize quality'),
+        recompress_level=tuning['png optimizer'].get('recompress level'),
+        timeout=tuning['png optimizer']['timeout seconds'],
+    )
+    limiter = RateLimiter(
+        global_rate=tuning['rate limits']['global per second'],
+        global_burst=tuning['rate limits']['global burst'],
+        private_rate=tuning['rate limits']['private chat per second'],
+        private_burst=tuning['rate limits']['private chat burst'],
+        group_rate=tuning['rate limits']['group chat per minute'] / 60,
+        group_burst=tuning['rate limits']['group chat burst'],
+    )
+    Transport(
+        pool_size=tuning['transport']['pool size'],
+        connect_timeout=tuning['transport']['connect timeout seconds'],
+        read_timeout=tuning['transport']['read timeout seconds'],
+        upload_timeout=tuning['transport']['upload timeout seconds'],
+        api_url=args.api_url or tuning['transport'].get('api url'),
+        flood_waits=tuning['transport']['flood control waits'],
+        max_flood_wait=tuning['transport']['max flood wait seconds'],
+        limiter=limiter,
+    ).install()
+    bot = TeleBot(os.environ['TG_API_KEY'])
+
+    def publish(theme: str) -> str:
+        png = mk_preview(theme, rsvg_convert, pool, optimizer)
+        msg = send_image(bot, args.chat, png, limiter=limiter)
+        file_kind, file_id = message_file_id(msg)
+        if file_kind != 'photo':
+            raise ValueError(f"preview was sent as a {file_kind}, not a photo")
+        return file_id
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=tuning['render pool']['workers']) as workers:
+        for theme, future in [
+            (theme, workers.submit(publish, theme)) for theme in stale
+        ]:
+            try:
+                file_ids[theme] = future.result()
+            except Exception as e:
+                failed.append(theme)
+                print(f"{theme}: failed: {e!r}")
+            else:
+                hashes[theme] = digests[theme]
+                print(f"{theme}: {file_ids[theme]}")
+
+    if len(failed) < len(stale):
+        published = [theme for theme in file_ids if file_ids[theme]]
+        text = replace_section(
+            text, 'theme_previews', {theme: file_ids[theme] for theme in published}
+        )
+        text = replace_section(
+            text,
+            'theme_preview_hashes',
+            {theme: hashes[theme] for theme in published if theme in hashes},
+        )
+        vars_file.write(text)
+        print(f"updated {vars_file}; now run mk/file_ids.sh -d {args.deployment}")
+    if failed:
+        sys.exit(f"failed: {', '.join(failed)}")
@@ -0,0 +1,39 @@
+#!/bin/sh -e
+# [-d <deployment>=dev] [-n <workers>=2]
+
+deployment=dev
+if [ "$1" = -d ]; then deployment=$2; shift 2; fi
+
+workers=2
+if [ "$1" = -n ]; then workers=$2; shift 2; fi
+
+if [ "$1" ]; then
+  printf '%s\n' 'Start the bot locally as a dispatcher and sharded workers, without process supervision or other svcs' 'Run start/local.sh first, to set up the venv' 'Args: [-d <deployment>=dev] [-n <workers>=2]'
+  exit 1
+fi
+
+cd "$(git -C "$(dirname -- "$0")" rev-parse --show-toplevel)"
+
+# shellcheck disable=SC1091
+. app/venv/bin/activate
+
+# Shared by the dispatcher and workers, unless already provided
+WEBHOOK_SECRET=${WEBHOOK_SECRET:-$(od -An -N16 -tx1 /dev/urandom | tr -d ' \n')}
+export WEBHOOK_SECRET
+
+pids=''
+trap 'kill $pids 2>/dev/null' EXIT INT TERM
+
+shard=0
+while [ "$shard" -lt "$workers" ]; do
+  sops exec-env "app/sops/colorcodebot.${deployment}.yml" \
+  "app/colorcodebot.py --mode worker --shard $shard --shards $workers" &
+  pids="$pids $!"
+  shard=$((shard + 1))
+done
+
+sops exec-env "app/sops/colorcodebot.${deployment}.yml" \
+"app/colorcodebot.py --mode dispatcher --shards $workers" &
+pids="$pids $!"
+
+wait